@@ -0,0 +1,106 @@
+"""
+This script compares the binary column format of common/codec.py with the original json.dumps / json.loads messages.
+
+For different message sizes it generates random payment rows (as sent through the 'data' queue)
+and log rows (as sent between the validator and the services) and prints the size of the message body
+as well as the time needed for encoding and decoding it.
+
+It does not need a running database or message queue:
+
+    python benchmarks/codec_benchmark.py
+"""
+
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from codec import encode_columns, decode_columns, PAYMENTS_SCHEMA, LOG_SCHEMA
+
+
+MESSAGE_SIZES = [1000, 10000, 100000]
+
+# Number of times each measurement is repeated, the fastest run is reported
+REPETITIONS = 5
+
+
+
+# ------------- Data generation ------------- #
+
+def generate_iban():
+    # Generates a random german IBAN with valid check digits
+    bban = ''.join(random.choices('0123456789', k=18))
+    check_digits = 98 - int(bban + '131400') % 97
+
+    return f"DE{check_digits:02d}{bban}"
+
+
+def generate_payment_rows(count):
+    start_date = datetime.date.today() - datetime.timedelta(days=365)
+
+    return [
+        [
+            payment_id,
+            f"${random.uniform(1, 1000):,.2f}",
+            generate_iban(),
+            (start_date + datetime.timedelta(days=random.randint(0, 365))).isoformat(),
+        ]
+        for payment_id in range(1, count + 1)
+    ]
+
+
+def generate_log_rows(payment_rows):
+    return [[row[0], False, row[2]] for row in payment_rows]
+
+
+
+# ------------- Measurement ------------- #
+
+def measure(function, argument):
+    # Returns the result and the fastest run time in milliseconds
+    fastest = None
+
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = (time.perf_counter() - start) * 1000
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+
+    return result, fastest
+
+
+def compare(name, rows, schema):
+    json_body, json_encode_time = measure(lambda data: json.dumps(data).encode(), rows)
+    _, json_decode_time = measure(json.loads, json_body)
+
+    columnar_body, columnar_encode_time = measure(lambda data: encode_columns(data, schema), rows)
+    decoded, columnar_decode_time = measure(decode_columns, columnar_body)
+
+    assert decoded == rows, "The binary format did not survive the round trip"
+
+    print(f"{name:<10} {len(rows):>8} rows | "
+          f"json: {len(json_body):>10} bytes, encode {json_encode_time:8.2f} ms, decode {json_decode_time:8.2f} ms | "
+          f"columns: {len(columnar_body):>10} bytes ({len(columnar_body) / len(json_body):5.1%}), "
+          f"encode {columnar_encode_time:8.2f} ms, decode {columnar_decode_time:8.2f} ms")
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    random.seed(42)
+
+    for size in MESSAGE_SIZES:
+        payment_rows = generate_payment_rows(size)
+
+        compare('payments', payment_rows, PAYMENTS_SCHEMA)
+        compare('log', generate_log_rows(payment_rows), LOG_SCHEMA)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+This script measures the hot queries of the EPLF services with 'EXPLAIN ANALYZE' before and after applying the migrations.
+
+It creates the EPLF tables of the chosen concept inside a separate schema ('index_benchmark') of the given database,
+fills them with 1,000,000 payments (of which 90% are logged and 5% of the logged ones are still unvalidated),
+runs every query without the indexes, applies the migrations of common/migrations.py and runs every query again.
+Queries that take longer than the statement timeout (e.g. the 'NOT IN' anti-join once 'Log' no longer fits into work_mem)
+are cancelled and reported as timed out.
+The schema is dropped afterwards, so it can be pointed at any PostgreSQL database:
+
+    python benchmarks/index_benchmark.py --host 192.168.0.23 --concept 1
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import psycopg2
+import psycopg2.errors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from migrations import apply_migrations, CONCEPT_1_EPLF, CONCEPT_2_EPLF
+
+
+SCHEMA = 'index_benchmark'
+
+
+
+# ------------- Setup functions ------------- #
+
+def create_tables(cursor, concept, payment_count):
+    # Creates and fills the tables the same way the 'init.sql' and 'fill_db.py' scripts do, only a lot faster
+    faulty_definition = ", faulty BOOLEAN" if concept == 1 else ""
+    faulty_column = ", faulty" if concept == 1 else ""
+    faulty_value = ", false" if concept == 1 else ""
+
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}")
+
+    cursor.execute("""
+        CREATE TABLE Payments (
+            id SERIAL PRIMARY KEY,
+            amount MONEY NOT NULL,
+            payment_date DATE NOT NULL,
+            iban TEXT NOT NULL
+        )
+    """)
+
+    cursor.execute(f"""
+        CREATE TABLE Log (
+            id SERIAL PRIMARY KEY,
+            payment_id INTEGER,
+            validated BOOLEAN,
+            inserted TIMESTAMP,
+            iban TEXT NOT NULL{faulty_definition},
+            FOREIGN KEY (payment_id) REFERENCES Payments(id)
+        )
+    """)
+
+    cursor.execute("""
+        INSERT INTO Payments (amount, payment_date, iban)
+        SELECT (random() * 1000)::numeric(10, 2)::money,
+               current_date - (random() * 365)::int,
+               'DE' || lpad((random() * 99)::int::text, 2, '0') || lpad((random() * 1e9)::bigint::text, 18, '0')
+        FROM generate_series(1, %s)
+    """, (payment_count,))
+
+    # 90% of the payments have been published, 5% of those are still waiting for their validation
+    cursor.execute(f"""
+        INSERT INTO Log (payment_id, validated, inserted, iban{faulty_column})
+        SELECT id,
+               random() > 0.05,
+               (now() AT TIME ZONE 'UTC') - (random() * interval '7 days'),
+               iban{faulty_value}
+        FROM Payments
+        WHERE id <= %s
+    """, (int(payment_count * 0.9),))
+
+    cursor.execute("ANALYZE")
+
+
+
+# ------------- Measurement functions ------------- #
+
+def get_queries(concept, payment_count):
+    # The queries as they are sent by the publish, republish, listen and validation services
+    faulty_filter = "AND faulty = false" if concept == 1 else ""
+    payment_id = int(payment_count * 0.45)
+
+    return {
+        "publish: unpublished payments (old anti-join)": """
+            SELECT id, amount, iban, TO_CHAR(payment_date, 'YYYY-MM-DD')
+            FROM Payments
+            WHERE id NOT IN (SELECT payment_id FROM Log)
+            LIMIT 5000
+        """,
+        "publish: unpublished payments (high-water mark)": f"""
+            SELECT id, amount, iban, TO_CHAR(payment_date, 'YYYY-MM-DD')
+            FROM Payments
+            WHERE id > {int(payment_count * 0.9)}
+            ORDER BY id
+            LIMIT 5000
+        """,
+        "republish / validation: unvalidated rows": f"""
+            SELECT *
+            FROM Log
+            WHERE validated = false
+            {faulty_filter}
+        """,
+        "republish: unvalidated rows older than 2 minutes": f"""
+            SELECT *
+            FROM Log
+            WHERE validated = false
+            {faulty_filter}
+            AND inserted < (now() AT TIME ZONE 'UTC') - interval '120 seconds'
+        """,
+        "listen / validation: update by payment_id": f"""
+            UPDATE Log SET validated = True WHERE payment_id = {payment_id}
+        """,
+    }
+
+
+def explain(cursor, query, timeout):
+    # Returns the planning and execution time in milliseconds and the top plan node,
+    # or None if the query did not finish within the timeout (in seconds)
+    cursor.execute("SET LOCAL statement_timeout = %s", (timeout * 1000,))
+
+    try:
+        cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}")
+    except psycopg2.errors.QueryCanceled:
+        return None
+
+    result = cursor.fetchone()[0]
+    plan = result[0] if isinstance(result, list) else json.loads(result)[0]
+
+    return plan["Planning Time"], plan["Execution Time"], plan["Plan"]["Node Type"]
+
+
+def run_queries(conn, queries, timeout):
+    results = {}
+    cursor = conn.cursor()
+
+    for name, query in queries.items():
+        results[name] = explain(cursor, query, timeout)
+
+        # Don't keep the changes of the UPDATE statement
+        conn.rollback()
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+
+    return results
+
+
+
+def print_result(label, result, timeout):
+    if result is None:
+        print(f"    {label + ':':<7} timed out after {timeout} s")
+        return
+
+    planning_time, execution_time, node_type = result
+    print(f"    {label + ':':<7} planning {planning_time:8.2f} ms, execution {execution_time:10.2f} ms ({node_type})")
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='192.168.0.23')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--dbname', default='db')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--concept', type=int, choices=[1, 2], default=2)
+    parser.add_argument('--payments', type=int, default=1000000)
+    parser.add_argument('--timeout', type=int, default=120, help="statement timeout per query in seconds")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(host=args.host, port=args.port, dbname=args.dbname, user=args.user, password=args.password)
+    cursor = conn.cursor()
+
+    try:
+        print(f"Creating {args.payments} payments in the '{SCHEMA}' schema ...")
+        create_tables(cursor, args.concept, args.payments)
+        conn.commit()
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+
+        queries = get_queries(args.concept, args.payments)
+        before = run_queries(conn, queries, args.timeout)
+
+        apply_migrations(conn, CONCEPT_1_EPLF if args.concept == 1 else CONCEPT_2_EPLF)
+        cursor.execute("ANALYZE")
+        conn.commit()
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+
+        after = run_queries(conn, queries, args.timeout)
+
+        print()
+        for name in queries:
+            print(name)
+            print_result("before", before[name], args.timeout)
+            print_result("after", after[name], args.timeout)
+
+    finally:
+        conn.rollback()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
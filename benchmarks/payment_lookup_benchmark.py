@@ -0,0 +1,222 @@
+"""
+This script compares the ways the EPLF republish service can look up the payments of the rows it resends.
+
+    - 'IN tuple':  the ids are formatted into the SQL text ("WHERE id IN (1, 2, ...)"), as republish.py used to do
+    - '= ANY':     the ids are bound as an array parameter ("WHERE id = ANY(%s::int[])") in chunks of --chunk-size ids
+    - 'join':      'Log' is joined with 'Payments' in a single query, so no ids are sent at all
+    - 'subquery':  the ids of the due 'Log' rows are collected by a subquery and looked up with "= ANY(ARRAY(...))"
+                   in a single query, which is what republish.py does now
+
+It creates the EPLF tables of concept 2 inside a separate schema ('payment_lookup_benchmark') of the given database,
+fills them with --payments payments and looks up 1,000, 10,000 and 100,000 of them with every method,
+once for payments spread randomly over the table and once for the most recent payments
+(the unvalidated rows are usually the recent ones).
+For each method, the size of the SQL text, the planning and execution time reported by 'EXPLAIN ANALYZE'
+and the wall-clock time of actually running the queries and fetching the rows are printed.
+The schema is dropped afterwards, so it can be pointed at any PostgreSQL database:
+
+    python benchmarks/payment_lookup_benchmark.py --host 192.168.0.23
+"""
+
+
+import time
+import json
+import random
+import argparse
+import psycopg2
+
+
+SCHEMA = 'payment_lookup_benchmark'
+
+SIZES = [1000, 10000, 100000]
+
+PAYMENT_COLUMNS = "p.id, p.amount, p.iban, TO_CHAR(p.payment_date, 'YYYY-MM-DD') AS payment_date"
+
+
+
+# ------------- Setup functions ------------- #
+
+def create_tables(cursor, payment_count):
+    # Creates and fills the tables the same way the 'init.sql' and 'fill_db.py' scripts do, only a lot faster.
+    # All rows of 'Log' start out validated, the rows to look up are marked as unvalidated per run.
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}")
+
+    cursor.execute("""
+        CREATE TABLE Payments (
+            id SERIAL PRIMARY KEY,
+            amount MONEY NOT NULL,
+            payment_date DATE NOT NULL,
+            iban TEXT NOT NULL
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE Log (
+            id SERIAL PRIMARY KEY,
+            payment_id INTEGER UNIQUE,
+            validated BOOLEAN,
+            inserted TIMESTAMP,
+            iban TEXT NOT NULL,
+            FOREIGN KEY (payment_id) REFERENCES Payments(id)
+        )
+    """)
+
+    cursor.execute("""
+        INSERT INTO Payments (amount, payment_date, iban)
+        SELECT (random() * 1000)::numeric(10, 2)::money,
+               current_date - (random() * 365)::int,
+               'DE' || lpad((random() * 99)::int::text, 2, '0') || lpad((random() * 1e9)::bigint::text, 18, '0')
+        FROM generate_series(1, %s)
+    """, (payment_count,))
+
+    cursor.execute("""
+        INSERT INTO Log (payment_id, validated, inserted, iban)
+        SELECT id, true, (now() AT TIME ZONE 'UTC') - interval '1 hour', iban
+        FROM Payments
+    """)
+
+    cursor.execute("CREATE INDEX log_unvalidated_idx ON Log (inserted) WHERE validated = false")
+    cursor.execute("ANALYZE")
+
+
+def mark_as_unvalidated(cursor, payment_ids):
+    # Makes exactly the given payments due to be resent
+    cursor.execute("UPDATE Log SET validated = true WHERE validated = false")
+    cursor.execute("UPDATE Log SET validated = false WHERE payment_id = ANY(%s)", (payment_ids,))
+    cursor.execute("ANALYZE Log")
+
+
+
+# ------------- Query builders ------------- #
+
+# Each builder returns the list of (query, parameters) that is needed to look up the given payments
+
+def in_tuple_queries(payment_ids, chunk_size):
+    return [(f"SELECT {PAYMENT_COLUMNS} FROM Payments p WHERE p.id IN {tuple(payment_ids)}", None)]
+
+
+def any_array_queries(payment_ids, chunk_size):
+    return [
+        (f"SELECT {PAYMENT_COLUMNS} FROM Payments p WHERE p.id = ANY(%s::int[])", (payment_ids[start:start + chunk_size],))
+        for start in range(0, len(payment_ids), chunk_size)
+    ]
+
+
+def join_queries(payment_ids, chunk_size):
+    return [(f"""
+        SELECT {PAYMENT_COLUMNS}
+        FROM Log l
+        JOIN Payments p ON p.id = l.payment_id
+        WHERE l.validated = false
+        AND l.inserted < (now() AT TIME ZONE 'UTC') - interval '120 seconds'
+    """, None)]
+
+
+def subquery_queries(payment_ids, chunk_size):
+    return [(f"""
+        SELECT {PAYMENT_COLUMNS}
+        FROM Payments p
+        WHERE p.id = ANY(ARRAY(
+            SELECT l.payment_id
+            FROM Log l
+            WHERE l.validated = false
+            AND l.inserted < (now() AT TIME ZONE 'UTC') - interval '120 seconds'
+        ))
+    """, None)]
+
+
+METHODS = {
+    "IN tuple": in_tuple_queries,
+    "= ANY": any_array_queries,
+    "join": join_queries,
+    "subquery": subquery_queries,
+}
+
+
+
+# ------------- Measurement functions ------------- #
+
+def measure(cursor, queries):
+    # Returns the size of the SQL text in bytes, the summed planning and execution time (in milliseconds)
+    # reported by 'EXPLAIN ANALYZE', the wall-clock time of running the queries and the number of fetched rows
+    sql_size = 0
+    planning_time = 0
+    execution_time = 0
+
+    for query, parameters in queries:
+        sql_size += len(cursor.mogrify(query, parameters))
+
+        cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", parameters)
+        result = cursor.fetchone()[0]
+        plan = result[0] if isinstance(result, list) else json.loads(result)[0]
+
+        planning_time += plan["Planning Time"]
+        execution_time += plan["Execution Time"]
+
+    fetched_rows = 0
+    start = time.perf_counter()
+
+    for query, parameters in queries:
+        cursor.execute(query, parameters)
+        fetched_rows += len(cursor.fetchall())
+
+    wall_time = (time.perf_counter() - start) * 1000
+
+    return sql_size, planning_time, execution_time, wall_time, fetched_rows
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='192.168.0.23')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--dbname', default='db')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--payments', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=10000, help="number of ids per '= ANY' query")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(host=args.host, port=args.port, dbname=args.dbname, user=args.user, password=args.password)
+    cursor = conn.cursor()
+
+    try:
+        print(f"Creating {args.payments} payments in the '{SCHEMA}' schema ...")
+        create_tables(cursor, args.payments)
+        conn.commit()
+
+        for distribution in ("random", "recent"):
+            for size in SIZES:
+                size = min(size, args.payments)
+
+                if distribution == "random":
+                    payment_ids = random.sample(range(1, args.payments + 1), size)
+                else:
+                    payment_ids = list(range(args.payments - size + 1, args.payments + 1))
+
+                mark_as_unvalidated(cursor, payment_ids)
+                conn.commit()
+
+                print(f"\n{len(payment_ids)} {distribution} ids")
+
+                for name, build_queries in METHODS.items():
+                    queries = build_queries(payment_ids, args.chunk_size)
+                    sql_size, planning_time, execution_time, wall_time, fetched_rows = measure(cursor, queries)
+
+                    print(f"    {name + ':':<10} {len(queries):>3} queries, {sql_size / 1024:8.1f} KiB of SQL, "
+                          f"planning {planning_time:8.2f} ms, execution {execution_time:8.2f} ms, "
+                          f"wall-clock {wall_time:8.2f} ms, {fetched_rows} rows")
+
+    finally:
+        conn.rollback()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+This script compares the ReconciliationStore of common/reconciliation.py, which the validator uses to compare
+the unvalidated rows of the EPLF and the ZD, with the nested loop the validator used before.
+
+For 1,000 up to 1,000,000 rows per side it generates synthetic 'Log' rows as sent by the validation services:
+the ZD has received most of the EPLF payments (a few of them with a different IBAN), misses some of them
+and has a few payments the EPLF doesn't know about. The rows of both sides arrive in a different order.
+
+The nested loop takes O(n·m), so it is only run up to --nested-limit rows per side.
+For larger inputs its time is extrapolated from the largest measured size and marked as such.
+
+The store is measured for a full round: an empty store receives the snapshots of both sides and the unmatched
+rows are expired right away, so every row ends up matched, missing in the ZD, missing in the EPLF or as a field mismatch.
+All four classes are checked against the nested loop. It is also measured for a delta round: the store already holds the unmatched rows of a full snapshot of the given size
+and receives DELTA_SHARE new rows per side.
+
+It does not need a running database or message queue:
+
+    python benchmarks/reconciliation_benchmark.py
+"""
+
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from reconciliation import (ReconciliationStore, EPLF, ZD,
+                            MATCHED, MISSING_IN_ZD, MISSING_IN_EPLF, FIELD_MISMATCH)
+
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+# Shares of the EPLF rows that are missing in the ZD or have a different IBAN there,
+# and share of additional ZD rows without an EPLF row
+MISSING_IN_ZD_SHARE = 0.05
+FIELD_MISMATCH_SHARE = 0.01
+MISSING_IN_EPLF_SHARE = 0.01
+
+# Number of new rows per side in a delta round, relative to the size of the backlog
+DELTA_SHARE = 0.01
+
+
+
+# ------------- Data generation ------------- #
+
+def generate_iban():
+    # Generates a random german IBAN with valid check digits
+    bban = ''.join(random.choices('0123456789', k=18))
+    check_digits = 98 - int(bban + '131400') % 97
+
+    return f"DE{check_digits:02d}{bban}"
+
+
+def generate_rows(count):
+    # Returns the unvalidated rows of both sides
+    eplf_rows = [[payment_id, False, generate_iban()] for payment_id in range(1, count + 1)]
+    zd_rows = []
+
+    for row in eplf_rows:
+        chance = random.random()
+
+        if chance < MISSING_IN_ZD_SHARE:
+            continue
+        elif chance < MISSING_IN_ZD_SHARE + FIELD_MISMATCH_SHARE:
+            zd_rows.append([row[0], False, generate_iban()])
+        else:
+            zd_rows.append(list(row))
+
+    zd_rows.extend(
+        [payment_id, False, generate_iban()]
+        for payment_id in range(count + 1, count + 1 + int(count * MISSING_IN_EPLF_SHARE))
+    )
+
+    random.shuffle(zd_rows)
+
+    return eplf_rows, zd_rows
+
+
+
+# ------------- Comparison methods ------------- #
+
+def nested_loop(eplf_rows, zd_rows):
+    # The comparison the validator used to do, extended to classify every row the same way as the store
+    result = {MATCHED: [], MISSING_IN_ZD: [], MISSING_IN_EPLF: [], FIELD_MISMATCH: []}
+
+    for eplf_row in eplf_rows:
+        zd_match = None
+
+        for zd_row in zd_rows:
+            if eplf_row[0] == zd_row[0]:
+                zd_match = zd_row
+
+        if zd_match is None:
+            result[MISSING_IN_ZD].append(eplf_row)
+        elif zd_match == eplf_row:
+            result[MATCHED].append(eplf_row)
+        else:
+            result[FIELD_MISMATCH].append((eplf_row, zd_match))
+
+    for zd_row in zd_rows:
+        if not any(eplf_row[0] == zd_row[0] for eplf_row in eplf_rows):
+            result[MISSING_IN_EPLF].append(zd_row)
+
+    return result
+
+
+def full_round(eplf_rows, zd_rows):
+    # Merges the snapshots of both sides into an empty store, as the validator does in its first round,
+    # and expires the unmatched rows right away. Returns the rows per class.
+    store = ReconciliationStore()
+
+    eplf_matches, _ = store.add(EPLF, eplf_rows, now=0)
+    zd_matches, _ = store.add(ZD, zd_rows, now=0)
+
+    result = store.expire(now=store.ttl + 1)
+    result[MATCHED] = eplf_matches + zd_matches
+
+    return result
+
+
+def format_round(result):
+    # Returns a one-line summary of the number of rows in each class
+    return ", ".join(f"{len(result[name])} {name.replace('_', ' ')}" for name in (MATCHED, MISSING_IN_ZD, MISSING_IN_EPLF, FIELD_MISMATCH))
+
+
+def delta_round(eplf_rows):
+    # Returns the time in milliseconds the store needs to merge a delta round into a backlog of the given EPLF rows
+    size = len(eplf_rows)
+
+    # Only the EPLF side of the backlog is unmatched, the ZD hasn't processed those payments yet
+    store = ReconciliationStore()
+    store.add(EPLF, eplf_rows)
+
+    delta_size = max(int(size * DELTA_SHARE), 1)
+    new_eplf_rows = [[payment_id, False, f"DE00{payment_id:018d}"] for payment_id in range(size + 1, size + 1 + delta_size)]
+    new_zd_rows = [list(row) for row in eplf_rows[:delta_size]] + [list(row) for row in new_eplf_rows[:delta_size // 2]]
+
+    start = time.perf_counter()
+    store.add(EPLF, new_eplf_rows)
+    store.add(ZD, new_zd_rows)
+    store.expire()
+
+    return (time.perf_counter() - start) * 1000, len(new_eplf_rows) + len(new_zd_rows)
+
+
+def measure(function, *arguments):
+    # Returns the result and the run time in milliseconds
+    start = time.perf_counter()
+    result = function(*arguments)
+
+    return result, (time.perf_counter() - start) * 1000
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rows', type=int, default=SIZES[-1], help="largest number of rows per side")
+    parser.add_argument('--nested-limit', type=int, default=10000, help="largest number of rows per side for the nested loop")
+    args = parser.parse_args()
+
+    random.seed(42)
+
+    # Largest measured nested loop as (number of comparisons, time), used for the extrapolation
+    nested_reference = None
+
+    for size in [size for size in SIZES if size <= args.max_rows]:
+        eplf_rows, zd_rows = generate_rows(size)
+
+        result, store_round_time = measure(full_round, eplf_rows, zd_rows)
+        comparisons = len(eplf_rows) * len(zd_rows)
+
+        if size <= args.nested_limit:
+            reference, nested_time = measure(nested_loop, eplf_rows, zd_rows)
+
+            for name, rows in reference.items():
+                assert sorted(rows) == sorted(result[name]), f"The store classified different rows as {name} than the nested loop"
+
+            nested_reference = (comparisons, nested_time)
+            nested = f"{nested_time:12.2f} ms"
+        elif nested_reference:
+            nested = f"{nested_reference[1] * comparisons / nested_reference[0]:12.0f} ms (extrapolated)"
+        else:
+            nested = "skipped"
+
+        store_time, delta_rows = delta_round(eplf_rows)
+
+        print(f"{size:>8} EPLF rows, {len(zd_rows):>8} ZD rows | store full round {store_round_time:10.2f} ms | "
+              f"nested loop {nested} | store delta round of {delta_rows} rows {store_time:8.2f} ms | {format_round(result)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+This script compares the ways the EPLF listen service of concept 1 can mark the rows of a 'validation' message.
+
+    - 'per row':  one "UPDATE Log SET validated = True WHERE payment_id = %s" per payment, as listen.py used to do
+    - 'unnest':   all payment ids are sent as one array parameter and joined with "FROM unnest(%s::int[])"
+                  in a single statement, which is what listen.py does now
+
+It creates the EPLF 'Log' table of concept 1 inside a separate schema ('validation_update_benchmark') of the given database,
+fills it with --payments rows and updates --rows random payments with both methods, once without an index on
+'payment_id' and once after applying the migrations of common/migrations.py (which add a unique index on it).
+Without the index every single-row UPDATE scans the whole table, so the per-row loop stops after --timeout seconds
+and its total time is extrapolated from the rows it managed to update.
+The schema is dropped afterwards, so it can be pointed at any PostgreSQL database:
+
+    python benchmarks/validation_update_benchmark.py --host 192.168.0.23
+"""
+
+
+import os
+import sys
+import time
+import random
+import argparse
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from migrations import apply_migrations, CONCEPT_1_EPLF
+
+
+SCHEMA = 'validation_update_benchmark'
+
+
+
+# ------------- Setup functions ------------- #
+
+def create_tables(cursor, payment_count):
+    # Creates and fills the tables the same way the 'init.sql' and 'fill_db.py' scripts do, only a lot faster
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}")
+
+    cursor.execute("""
+        CREATE TABLE Payments (
+            id SERIAL PRIMARY KEY,
+            amount MONEY NOT NULL,
+            payment_date DATE NOT NULL,
+            iban TEXT NOT NULL
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE Log (
+            id SERIAL PRIMARY KEY,
+            payment_id INTEGER,
+            validated BOOLEAN,
+            inserted TIMESTAMP,
+            iban TEXT NOT NULL,
+            faulty BOOLEAN,
+            FOREIGN KEY (payment_id) REFERENCES Payments(id)
+        )
+    """)
+
+    cursor.execute("""
+        INSERT INTO Payments (amount, payment_date, iban)
+        SELECT (random() * 1000)::numeric(10, 2)::money,
+               current_date - (random() * 365)::int,
+               'DE' || lpad((random() * 99)::int::text, 2, '0') || lpad((random() * 1e9)::bigint::text, 18, '0')
+        FROM generate_series(1, %s)
+    """, (payment_count,))
+
+    cursor.execute("""
+        INSERT INTO Log (payment_id, validated, inserted, iban, faulty)
+        SELECT id, false, (now() AT TIME ZONE 'UTC') - (random() * interval '7 days'), iban, false
+        FROM Payments
+    """)
+
+    cursor.execute("ANALYZE")
+
+
+
+# ------------- Update methods ------------- #
+
+# Each method updates the given payments and returns the number of payments it got through within the timeout
+
+def update_per_row(cursor, payment_ids, timeout):
+    deadline = time.perf_counter() + timeout
+
+    for count, payment_id in enumerate(payment_ids, start=1):
+        cursor.execute("UPDATE Log SET validated = True WHERE payment_id = %s", (payment_id,))
+
+        if time.perf_counter() > deadline:
+            return count
+
+    return len(payment_ids)
+
+
+def update_unnest(cursor, payment_ids, timeout):
+    cursor.execute("""
+        UPDATE Log SET validated = True
+        FROM unnest(%s::int[]) AS ids(payment_id)
+        WHERE Log.payment_id = ids.payment_id
+    """, (payment_ids,))
+
+    return len(payment_ids)
+
+
+METHODS = {
+    "per row": update_per_row,
+    "unnest": update_unnest,
+}
+
+
+
+# ------------- Measurement functions ------------- #
+
+def run_methods(conn, payment_ids, timeout):
+    # Returns the measured (or extrapolated) time in milliseconds and the number of updated payments per method.
+    # The changes are rolled back after every method, so each of them starts from the same table.
+    results = {}
+    cursor = conn.cursor()
+
+    for name, update in METHODS.items():
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+
+        start = time.perf_counter()
+        updated = update(cursor, payment_ids, timeout)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        conn.rollback()
+
+        results[name] = (elapsed * len(payment_ids) / updated, updated)
+
+    return results
+
+
+def print_results(label, results, row_count):
+    print(label)
+
+    for name, (elapsed, updated) in results.items():
+        extrapolated = f" (extrapolated from {updated} rows)" if updated < row_count else ""
+        print(f"    {name + ':':<9} {elapsed:12.2f} ms, {row_count / elapsed * 1000:12.0f} rows/s{extrapolated}")
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='192.168.0.23')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--dbname', default='db')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--payments', type=int, default=1000000)
+    parser.add_argument('--rows', type=int, default=10000, help="number of payments per validation message")
+    parser.add_argument('--timeout', type=int, default=60, help="time limit of the per-row loop in seconds")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(host=args.host, port=args.port, dbname=args.dbname, user=args.user, password=args.password)
+    cursor = conn.cursor()
+
+    try:
+        print(f"Creating {args.payments} payments in the '{SCHEMA}' schema ...")
+        create_tables(cursor, args.payments)
+        conn.commit()
+
+        payment_ids = random.sample(range(1, args.payments + 1), min(args.rows, args.payments))
+
+        without_index = run_methods(conn, payment_ids, args.timeout)
+
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+        apply_migrations(conn, CONCEPT_1_EPLF)
+        cursor.execute("ANALYZE")
+        conn.commit()
+
+        with_index = run_methods(conn, payment_ids, args.timeout)
+
+        print(f"\nUpdating {len(payment_ids)} random payments")
+        print_results("without index on 'payment_id'", without_index, len(payment_ids))
+        print_results("with index on 'payment_id'", with_index, len(payment_ids))
+
+    finally:
+        conn.rollback()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+This module is copied into every container that publishes or consumes messages containing payment or log rows.
+
+It encodes the rows either as JSON (the original format) or in a compact binary, column oriented format.
+The format of a message is stated in its AMQP 'content_type' property, so consumers can read both formats
+and messages without a content type (sent by older publishers) are treated as JSON.
+
+Two kinds of rows are sent through the queues:
+    - payment rows: [id, amount, iban, payment_date], e.g. [1, "$12.34", "DE89370400440532013000", "2023-06-01"]
+    - log rows:     [payment_id, validated, iban],      e.g. [1, false, "DE89370400440532013000"]
+
+The binary format stores each column of a message separately:
+    - ids as int32 values
+    - amounts as int64 values in cents
+    - dates as uint16 values counting the days since 1970-01-01
+    - validated flags as one byte per row
+    - IBANs as a dictionary of the distinct IBANs followed by one index per row
+
+Messages of the concept 1 'validation' queue ({"type": ..., "data": [...]}) keep their type in the binary header.
+
+Large bodies are additionally compressed by compression.py, which is stated in the 'content_encoding' property.
+"""
+
+
+import sys
+import json
+import array
+import struct
+import datetime
+from functools import lru_cache
+import pika
+from compression import compress_body, decompress_body
+
+
+JSON_CONTENT_TYPE = 'application/json'
+COLUMNAR_CONTENT_TYPE = 'application/x-payment-columns'
+
+# The format used by the publishers. Switch back to JSON_CONTENT_TYPE if there are consumers that can only read JSON.
+CONTENT_TYPE = COLUMNAR_CONTENT_TYPE
+
+PAYMENTS_SCHEMA = 'payments'
+LOG_SCHEMA = 'log'
+
+
+_MAGIC = b'PCOL'
+_VERSION = 1
+
+_SCHEMA_CODES = {PAYMENTS_SCHEMA: 1, LOG_SCHEMA: 2}
+_SCHEMA_NAMES = {code: name for name, code in _SCHEMA_CODES.items()}
+
+# Flags stored in the header
+_HAS_TYPE = 1
+_WIDE_IBAN_INDEXES = 2
+
+# magic, version, schema, flags, number of rows
+_HEADER = struct.Struct('<4sBBBI')
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+
+# ------------- Public functions ------------- #
+
+def encode_message(data, schema, content_type=CONTENT_TYPE, headers=None, message_id=None):
+    # Encodes the rows (or the dictionary containing the rows) of a message and compresses the result if it is large.
+    # Returns the body and the matching pika.BasicProperties, which have to be passed to 'basic_publish' together.
+    if content_type == JSON_CONTENT_TYPE:
+        body = json.dumps(data).encode()
+    elif content_type == COLUMNAR_CONTENT_TYPE:
+        body = encode_columns(data, schema)
+    else:
+        raise ValueError(f"Unsupported content type: {content_type}")
+
+    body, content_encoding = compress_body(body)
+
+    properties = pika.BasicProperties(
+        content_type=content_type,
+        content_encoding=content_encoding,
+        headers=headers,
+        message_id=message_id,
+    )
+
+    return body, properties
+
+
+def decode_message(body, properties):
+    # Decompresses and decodes the body of a received message based on its content encoding and content type.
+    # Returns None for empty messages, which are used as triggers.
+    if not body:
+        return None
+
+    content_type = properties.content_type if properties else None
+    body = decompress_body(body, properties.content_encoding if properties else None)
+
+    if content_type in (None, JSON_CONTENT_TYPE):
+        return json.loads(body)
+    elif content_type == COLUMNAR_CONTENT_TYPE:
+        return decode_columns(body)
+
+    raise ValueError(f"Unsupported content type: {content_type}")
+
+
+
+# ------------- Value conversion functions ------------- #
+
+def money_to_cents(amount):
+    # Converts an amount like "$1,234.56" (as returned by PostgreSQL for MONEY columns) into 123456
+    if isinstance(amount, int):
+        return amount * 100
+
+    text = str(amount).replace('$', '').replace(',', '').strip()
+    negative = text.startswith('-')
+    units, _, fraction = text.lstrip('-').partition('.')
+    cents = int(units or 0) * 100 + int((fraction + '00')[:2])
+
+    return -cents if negative else cents
+
+
+def cents_to_money(cents):
+    # Converts 123456 back into "$1,234.56", the way PostgreSQL formats MONEY values
+    sign = '-' if cents < 0 else ''
+    units, fraction = divmod(abs(cents), 100)
+
+    return f"{sign}${units:,}.{fraction:02d}"
+
+
+# Payment dates only span a few hundred distinct days, so their conversions are cached
+@lru_cache(maxsize=4096)
+def date_to_days(date):
+    # Converts a date (or a 'YYYY-MM-DD' string) into the number of days since 1970-01-01
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+
+    return date.toordinal() - _EPOCH
+
+
+@lru_cache(maxsize=4096)
+def days_to_date(days):
+    # Converts the number of days since 1970-01-01 back into a 'YYYY-MM-DD' string
+    return datetime.date.fromordinal(days + _EPOCH).isoformat()
+
+
+
+# ------------- Binary encoding ------------- #
+
+def encode_columns(data, schema):
+    # Encodes the rows of a message into the binary column format
+    message_type = None
+    rows = data
+
+    if isinstance(data, dict):
+        message_type = data['type']
+        rows = data['data']
+
+    flags = _HAS_TYPE if message_type is not None else 0
+
+    iban_dictionary, iban_indexes = _build_iban_dictionary(row[2] for row in rows)
+
+    if len(iban_dictionary) > 0xFFFF:
+        flags |= _WIDE_IBAN_INDEXES
+
+    parts = [_HEADER.pack(_MAGIC, _VERSION, _SCHEMA_CODES[schema], flags, len(rows))]
+
+    if message_type is not None:
+        encoded_type = message_type.encode()
+        parts.append(struct.pack('<H', len(encoded_type)))
+        parts.append(encoded_type)
+
+    parts.append(_pack('i', [row[0] for row in rows]))
+
+    if schema == PAYMENTS_SCHEMA:
+        parts.append(_pack('q', [money_to_cents(row[1]) for row in rows]))
+        parts.append(_pack('H', [date_to_days(row[3]) for row in rows]))
+    else:
+        parts.append(bytes(1 if row[1] else 0 for row in rows))
+
+    parts.append(_encode_iban_dictionary(iban_dictionary))
+    parts.append(_pack('I' if flags & _WIDE_IBAN_INDEXES else 'H', iban_indexes))
+
+    return b''.join(parts)
+
+
+def decode_columns(body):
+    # Decodes a message in the binary column format back into the same structure as its JSON counterpart
+    magic, version, schema_code, flags, row_count = _HEADER.unpack_from(body, 0)
+
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Message is not in the payment column format")
+
+    schema = _SCHEMA_NAMES[schema_code]
+    offset = _HEADER.size
+    message_type = None
+
+    if flags & _HAS_TYPE:
+        (type_length,) = struct.unpack_from('<H', body, offset)
+        offset += 2
+        message_type = body[offset:offset + type_length].decode()
+        offset += type_length
+
+    ids, offset = _unpack('i', body, offset, row_count)
+
+    if schema == PAYMENTS_SCHEMA:
+        cents, offset = _unpack('q', body, offset, row_count)
+        days, offset = _unpack('H', body, offset, row_count)
+    else:
+        validated = [flag == 1 for flag in body[offset:offset + row_count]]
+        offset += row_count
+
+    iban_dictionary, offset = _decode_iban_dictionary(body, offset)
+    iban_indexes, offset = _unpack('I' if flags & _WIDE_IBAN_INDEXES else 'H', body, offset, row_count)
+    ibans = [iban_dictionary[index] for index in iban_indexes]
+
+    if schema == PAYMENTS_SCHEMA:
+        rows = [
+            [payment_id, cents_to_money(amount), iban, days_to_date(day)]
+            for payment_id, amount, iban, day in zip(ids, cents, ibans, days)
+        ]
+    else:
+        rows = [list(row) for row in zip(ids, validated, ibans)]
+
+    if message_type is not None:
+        return {"type": message_type, "data": rows}
+
+    return rows
+
+
+def _build_iban_dictionary(ibans):
+    # Returns the list of distinct IBANs and the index of each row's IBAN in that list
+    positions = {}
+    indexes = [positions.setdefault(iban, len(positions)) for iban in ibans]
+
+    return list(positions), indexes
+
+
+def _encode_iban_dictionary(iban_dictionary):
+    # Each entry is stored as its length (one byte) followed by its characters
+    parts = [struct.pack('<I', len(iban_dictionary))]
+
+    for iban in iban_dictionary:
+        encoded_iban = iban.encode()
+        parts.append(bytes((len(encoded_iban),)))
+        parts.append(encoded_iban)
+
+    return b''.join(parts)
+
+
+def _decode_iban_dictionary(body, offset):
+    (entry_count,) = struct.unpack_from('<I', body, offset)
+    offset += 4
+    entries = []
+
+    for _ in range(entry_count):
+        length = body[offset]
+        entries.append(body[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+
+    return entries, offset
+
+
+def _pack(typecode, values):
+    # Packs the values into a little-endian array of the given type
+    column = array.array(typecode, values)
+
+    if not _LITTLE_ENDIAN:
+        column.byteswap()
+
+    return column.tobytes()
+
+
+def _unpack(typecode, body, offset, count):
+    # Reads a little-endian array of the given type, returns the values and the offset behind them
+    column = array.array(typecode)
+    end = offset + column.itemsize * count
+    column.frombytes(body[offset:end])
+
+    if not _LITTLE_ENDIAN:
+        column.byteswap()
+
+    return column.tolist(), end
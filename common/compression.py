@@ -0,0 +1,59 @@
+"""
+This module is copied into every container that uses codec.py, which applies it to the encoded message bodies.
+
+Message bodies larger than COMPRESSION_THRESHOLD bytes are compressed with zlib before they are published,
+which is stated in the AMQP 'content_encoding' property of the message. Smaller bodies are sent as they are.
+Consumers decompress the bodies based on that property, so messages from older publishers are still readable.
+
+For every compressed or decompressed message, the size before and after as well as the used CPU time are printed.
+"""
+
+
+import time
+import zlib
+
+
+# Bodies larger than this (in bytes) are compressed
+COMPRESSION_THRESHOLD = 16 * 1024
+
+# zlib compression level between 1 (fastest) and 9 (smallest)
+COMPRESSION_LEVEL = 6
+
+DEFLATE_ENCODING = 'deflate'
+
+
+
+# ------------- Compression functions ------------- #
+
+def compress_body(body, threshold=COMPRESSION_THRESHOLD):
+    # Compresses the body if it is larger than the threshold.
+    # Returns the (possibly compressed) body and its content encoding, which is None for uncompressed bodies.
+    if len(body) <= threshold:
+        return body, None
+
+    start = time.thread_time()
+    compressed_body = zlib.compress(body, COMPRESSION_LEVEL)
+    cpu_time = (time.thread_time() - start) * 1000
+
+    print(f"Compressed message from {len(body)} to {len(compressed_body)} bytes "
+          f"(ratio {len(body) / len(compressed_body):.1f}:1) using {cpu_time:.1f} ms of CPU time.")
+
+    return compressed_body, DEFLATE_ENCODING
+
+
+def decompress_body(body, content_encoding):
+    # Decompresses the body according to the content encoding of the message
+    if not content_encoding:
+        return body
+
+    if content_encoding != DEFLATE_ENCODING:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+    start = time.thread_time()
+    decompressed_body = zlib.decompress(body)
+    cpu_time = (time.thread_time() - start) * 1000
+
+    print(f"Decompressed message from {len(body)} to {len(decompressed_body)} bytes "
+          f"(ratio {len(decompressed_body) / len(body):.1f}:1) using {cpu_time:.1f} ms of CPU time.")
+
+    return decompressed_body
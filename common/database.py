@@ -0,0 +1,235 @@
+"""
+This module is copied into every container that talks to one of the PostgreSQL databases.
+
+Instead of opening (and authenticating) a new connection for every received message,
+each service creates one ConnectionPool on startup and checks a connection out for every callback / iteration:
+
+    db_pool = ConnectionPool(host='192.168.0.24', dbname='db', user='postgres', password='postgres')
+
+    with db_pool.connection() as conn:
+        ...
+
+Connections are only opened when they are needed and are kept open afterwards.
+Before a connection is handed out again, it is checked for being closed and, if it has been idle for a while, pinged with 'SELECT 1'.
+Broken connections are thrown away and replaced by new ones, which are opened with an exponential backoff between the attempts.
+
+Large result sets can be streamed with stream_rows, which reads them through a named (server-side) cursor
+in chunks of ITERSIZE rows instead of loading them into memory with fetchall():
+
+    for rows in stream_rows(conn, "SELECT payment_id, validated, iban FROM Log WHERE validated = false"):
+        ...
+"""
+
+
+import time
+import queue
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+
+# Maximum number of connections a single pool keeps open
+POOL_SIZE = 4
+
+# Connections that have been idle for longer than this (in seconds) are pinged before they are handed out again
+HEALTH_CHECK_INTERVAL = 30
+
+# Number of attempts and the delays (in seconds) used when (re)connecting to the database
+CONNECT_ATTEMPTS = 8
+BACKOFF_BASE_DELAY = 0.5
+BACKOFF_MAX_DELAY = 30
+
+# Errors that mean the database can't be reached right now (e.g. while it restarts), as opposed to errors caused by the data.
+# Work that fails with one of them is worth retrying.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Number of rows a server-side cursor transfers per round trip (and per chunk yielded by stream_rows)
+ITERSIZE = 2000
+
+
+
+# ------------- Connection functions ------------- #
+
+def connect_to_db(host, dbname, user, password, port=5432, attempts=CONNECT_ATTEMPTS):
+    # Opens a new connection, retrying with an exponentially growing delay if the database can not be reached.
+    # Raises the last error if the database still can not be reached after all attempts.
+    for attempt in range(attempts):
+        try:
+            conn = psycopg2.connect(
+                host=host,
+                database=dbname,
+                user=user,
+                password=password,
+                port=port,
+            )
+            print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
+            return conn
+
+        except psycopg2.OperationalError as e:
+            if attempt == attempts - 1:
+                raise
+
+            delay = backoff_delay(attempt)
+            print(f"Error occurred: {e}")
+            print(f"Retrying to connect to {host} in {delay} seconds.")
+            time.sleep(delay)
+
+
+def backoff_delay(attempt):
+    # Returns the delay (in seconds) before the next attempt, doubling with every failed attempt up to BACKOFF_MAX_DELAY
+    return min(BACKOFF_BASE_DELAY * 2 ** attempt, BACKOFF_MAX_DELAY)
+
+
+def is_connection_healthy(conn):
+    # Returns True if the connection is still usable, False otherwise
+    if conn.closed:
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+
+def stream_rows(conn, query, params=None, name='stream_rows', itersize=ITERSIZE):
+    # Runs the query with a named server-side cursor and yields its rows in lists of at most itersize rows,
+    # so only one chunk is held in memory at a time no matter how large the result is.
+    # The cursor lives inside the current transaction, which must not be committed before the generator is exhausted.
+    with conn.cursor(name=name) as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query, params)
+
+        while True:
+            rows = cursor.fetchmany(itersize)
+
+            if not rows:
+                return
+
+            yield rows
+
+
+
+# ------------- Connection pool ------------- #
+
+class ConnectionPool:
+
+    def __init__(self, host, dbname, user, password, port=5432, size=POOL_SIZE):
+        self.connection_parameters = dict(host=host, dbname=dbname, user=user, password=password, port=port)
+        self.size = size
+
+        # Idle connections, the most recently used one is handed out first
+        self._idle_connections = queue.LifoQueue()
+
+        # Time at which each idle connection was returned to the pool
+        self._returned_at = {}
+
+        self._open_connections = 0
+        self._lock = threading.Lock()
+
+
+    def get_connection(self):
+        # Checks out a healthy connection, opening a new one if there is no idle one and the pool is not full yet.
+        # Blocks until a connection is returned if the pool is full.
+        while True:
+            try:
+                conn = self._idle_connections.get_nowait()
+            except queue.Empty:
+                conn = self._open_new_connection()
+
+                if conn is not None:
+                    return conn
+
+                # The pool is full, wait for a connection to be returned (or discarded, which frees up a slot)
+                try:
+                    conn = self._idle_connections.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+            idle_time = time.monotonic() - self._returned_at.pop(id(conn), 0)
+
+            if conn.closed or (idle_time > HEALTH_CHECK_INTERVAL and not is_connection_healthy(conn)):
+                print(f"Discarding broken connection with id {id(conn)}")
+                self._discard(conn)
+                continue
+
+            return conn
+
+
+    def put_connection(self, conn, discard=False):
+        # Returns a connection to the pool, rolling back anything that was left uncommitted
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+
+        self._returned_at[id(conn)] = time.monotonic()
+        self._idle_connections.put(conn)
+
+
+    @contextmanager
+    def connection(self):
+        # Checks out a connection for the duration of the with block.
+        # If the block fails because the connection broke, the connection is discarded instead of being returned.
+        conn = self.get_connection()
+
+        try:
+            yield conn
+        except TRANSIENT_ERRORS:
+            self.put_connection(conn, discard=True)
+            raise
+        except BaseException:
+            self.put_connection(conn)
+            raise
+        else:
+            self.put_connection(conn)
+
+
+    def close_all(self):
+        # Closes all idle connections, e.g. when the service shuts down
+        while True:
+            try:
+                conn = self._idle_connections.get_nowait()
+            except queue.Empty:
+                return
+
+            self._discard(conn)
+
+
+    def _open_new_connection(self):
+        # Opens a new connection if the pool is not full yet, returns None otherwise
+        with self._lock:
+            if self._open_connections >= self.size:
+                return None
+
+            self._open_connections += 1
+
+        try:
+            return connect_to_db(**self.connection_parameters)
+        except BaseException:
+            with self._lock:
+                self._open_connections -= 1
+            raise
+
+
+    def _discard(self, conn):
+        self._returned_at.pop(id(conn), None)
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        with self._lock:
+            self._open_connections -= 1
@@ -0,0 +1,165 @@
+"""
+This module is copied into every container that publishes payments to the RabbitMQ 'data' queue.
+
+Instead of publishing a fixed (or random) number of rows, the publishers ask a FlowController how many rows
+the consumers of the queue can take right now:
+
+    flow_controller = FlowController(channel, 'data', rows_per_message=CHUNK_SIZE)
+
+    batch_size = flow_controller.next_batch_size(wanted_rows)
+    ...
+    flow_controller.record_published(rows, messages)
+
+The controller reads the depth and the number of consumers of the queue with a passive 'queue_declare',
+which neither creates nor changes the queue. Each batch is sized so that the backlog of the queue approaches
+TARGET_BACKLOG rows. If the backlog is already above the target or no consumer is attached, the batch size is 0
+and the publisher should wait for pause_time() seconds before asking again.
+
+The rate at which the consumers drain the queue is estimated from the change of the depth between two observations.
+The current batch size, backlog and rate are printed with every decision and available through metrics().
+
+The same estimate tells how long published rows will probably stay in the queue and in processing.
+The publishers lease the rows they publish for lease_time() seconds, so the republish service doesn't resend
+rows the ZD hasn't even received yet.
+"""
+
+
+import time
+
+
+# Number of rows the publishers try to keep waiting in the queue, enough to keep the consumers busy
+TARGET_BACKLOG = 20000
+
+# Limits of a single batch, smaller batches are not worth a round trip to the database
+MIN_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 10000
+
+# Limits (in seconds) of the time the publishers wait while the consumers are behind
+MIN_PAUSE = 1
+MAX_PAUSE = 60
+
+# Weight of the newest observation in the moving averages of the rate and the rows per message
+SMOOTHING = 0.3
+
+# Limits (in seconds) of the lease of published rows, which is LEASE_MARGIN times the expected time in the queue
+MIN_LEASE = 120
+MAX_LEASE = 3600
+LEASE_MARGIN = 2
+
+
+
+# ------------- Flow controller ------------- #
+
+class FlowController:
+
+    def __init__(self, channel, queue, rows_per_message, target_backlog=TARGET_BACKLOG,
+                 min_batch_size=MIN_BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE):
+        self.channel = channel
+        self.queue = queue
+        self.target_backlog = target_backlog
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+
+        # Estimated from the published batches, as a message can contain any number of rows
+        self.rows_per_message = rows_per_message
+
+        # Last observation of the queue
+        self.message_count = 0
+        self.consumer_count = 0
+        self.observed_at = None
+
+        # Messages published since the last observation, needed to tell how many messages were consumed in between
+        self.published_messages = 0
+
+        # Estimated number of rows the consumers take from the queue per second
+        self.rate = None
+
+        self.batch_size = 0
+
+
+    def observe(self):
+        # Reads the current depth and consumer count of the queue and updates the estimated consumption rate
+        result = self.channel.queue_declare(queue=self.queue, passive=True)
+        now = time.monotonic()
+
+        message_count = result.method.message_count
+        consumer_count = result.method.consumer_count
+
+        if self.observed_at is not None and now > self.observed_at:
+            consumed_messages = max(self.message_count + self.published_messages - message_count, 0)
+            rate = consumed_messages * self.rows_per_message / (now - self.observed_at)
+            self.rate = rate if self.rate is None else SMOOTHING * rate + (1 - SMOOTHING) * self.rate
+
+        self.message_count = message_count
+        self.consumer_count = consumer_count
+        self.observed_at = now
+        self.published_messages = 0
+
+
+    def backlog(self):
+        # Estimated number of rows waiting in the queue
+        return int(self.message_count * self.rows_per_message)
+
+
+    def next_batch_size(self, wanted_rows=None):
+        # Returns the number of rows that should be published next, at most wanted_rows.
+        # Returns 0 if the consumers are too far behind or there are no consumers at all.
+        self.observe()
+
+        wanted_rows = self.max_batch_size if wanted_rows is None else wanted_rows
+        headroom = self.target_backlog - self.backlog()
+
+        if self.consumer_count == 0 or headroom <= 0:
+            self.batch_size = 0
+        else:
+            self.batch_size = min(max(headroom, self.min_batch_size), self.max_batch_size, wanted_rows)
+
+        print(f"Flow control for '{self.queue}': backlog {self.backlog()} rows, {self.consumer_count} consumers, "
+              f"rate {self.format_rate()}, next batch {self.batch_size} rows.")
+
+        return self.batch_size
+
+
+    def record_published(self, rows, messages):
+        # Has to be called after publishing, so the next observation can tell published from consumed messages
+        if messages <= 0:
+            return
+
+        self.published_messages += messages
+        self.rows_per_message = SMOOTHING * (rows / messages) + (1 - SMOOTHING) * self.rows_per_message
+
+
+    def pause_time(self):
+        # Returns the number of seconds until the consumers are expected to have worked off the excess backlog
+        if not self.rate or self.consumer_count == 0:
+            return MAX_PAUSE
+
+        excess_rows = self.backlog() - self.target_backlog + self.min_batch_size
+        return min(max(excess_rows / self.rate, MIN_PAUSE), MAX_PAUSE)
+
+
+    def lease_time(self, rows=0):
+        # Returns the number of seconds the given number of rows, published now, are expected to stay
+        # in the queue or in processing, with a safety margin
+        if not self.rate:
+            return MAX_LEASE
+
+        queue_time = (self.backlog() + rows) / self.rate
+        return min(max(queue_time * LEASE_MARGIN, MIN_LEASE), MAX_LEASE)
+
+
+    def format_rate(self):
+        return "unknown" if self.rate is None else f"{self.rate:.0f} rows/s"
+
+
+    def metrics(self):
+        # Returns the current state of the controller
+        return {
+            'queue': self.queue,
+            'batch_size': self.batch_size,
+            'backlog': self.backlog(),
+            'message_count': self.message_count,
+            'consumer_count': self.consumer_count,
+            'rate': self.rate,
+            'rows_per_message': self.rows_per_message,
+        }
@@ -0,0 +1,96 @@
+"""
+This module is copied into the containers that need to validate IBANs (currently the ZD-listen containers of both concepts).
+
+Instead of constructing a full schwifty.IBAN object for every row, it checks each IBAN with the same rules schwifty uses:
+    - the country code has to be known and the IBAN has to have the country specific length
+    - the BBAN has to match the country specific format
+    - the check digits have to be between 02 and 98 and the mod-97 checksum of the rearranged IBAN has to be 1
+
+The country specific lengths and formats are read from the schwifty registry only once when the module is imported.
+
+The results of recently validated IBANs are kept in a bounded LRU cache,
+as republished messages contain the same IBANs over and over again.
+"""
+
+
+import re
+import string
+from functools import lru_cache
+from schwifty import registry
+
+
+# Maximum number of IBAN results that are kept in the cache
+CACHE_SIZE = 100000
+
+
+# Maps the letters A-Z to the numbers 10-35 as required by the mod-97 calculation
+_LETTERS_TO_DIGITS = str.maketrans({letter: str(number) for number, letter in enumerate(string.ascii_uppercase, start=10)})
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+
+# ------------- Country tables ------------- #
+
+def load_country_specs():
+    # Returns a dictionary mapping each country code to its IBAN length and compiled BBAN format
+    return {
+        country_code: (spec["iban_length"], spec["regex"])
+        for country_code, spec in registry.get("iban").items()
+    }
+
+
+COUNTRY_SPECS = load_country_specs()
+
+
+
+# ------------- Validation functions ------------- #
+
+def has_valid_checksum(iban):
+    # Returns True if the mod-97 checksum of the compact IBAN is correct, False otherwise.
+    # The first 4 characters are moved to the end and the letters are replaced by numbers before calculating the remainder.
+    rearranged = (iban[4:] + iban[:4]).translate(_LETTERS_TO_DIGITS)
+
+    if not rearranged.isdigit():
+        return False
+
+    return int(rearranged) % 97 == 1
+
+
+def is_iban_valid(iban):
+    # Returns True if the IBAN is valid, False otherwise.
+    # Anything that isn't a string is invalid, the type is checked before the cache, which can only hold hashable values.
+    if not isinstance(iban, str):
+        return False
+
+    return _is_iban_valid_cached(iban)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _is_iban_valid_cached(iban: str):
+    # Remove all whitespace, the same way schwifty does it
+    iban = _WHITESPACE.sub("", iban).upper()
+
+    spec = COUNTRY_SPECS.get(iban[:2])
+
+    if spec is None:
+        return False
+
+    iban_length, bban_format = spec
+
+    if len(iban) != iban_length or not bban_format.match(iban[4:]):
+        return False
+
+    # Check digits outside of 02-98 can never be calculated, even if the remainder happens to be 1
+    check_digits = iban[2:4]
+
+    if not check_digits.isdigit() or not 2 <= int(check_digits) <= 98:
+        return False
+
+    return has_valid_checksum(iban)
+
+
+def validate_ibans(ibans):
+    # Validates a whole column of IBANs (e.g. all the IBANs of a received message) in one call
+    # and returns a list of booleans in the same order
+    return [is_iban_valid(iban) for iban in ibans]
@@ -0,0 +1,85 @@
+"""
+This module is copied into every container that consumes the small result messages of the validation.
+
+Instead of committing and acknowledging every message on its own, the consumers collect the deliveries of a queue
+into micro-batches of up to BATCH_SIZE messages, or as many as arrive within BATCH_WAIT seconds of the first one:
+
+    consumer = MicroBatchConsumer(connection, channel, 'validation', handle_batch)
+    channel.start_consuming()
+
+handle_batch receives the list of (method, properties, body) tuples of a batch and is expected to apply all of them
+in a single transaction. Afterwards, the whole batch is acknowledged with one 'basic_ack(multiple=True)'.
+If handle_batch raises, the whole batch is rejected with one 'basic_nack(multiple=True, requeue=True)',
+so its messages are delivered again.
+
+The prefetch count of the channel is set to the batch size, so a batch can fill up without waiting for acknowledgements.
+Acknowledging with 'multiple' covers every unacknowledged delivery of the channel, so the channel must not be
+shared with another consumer.
+"""
+
+
+# Maximum number of messages per batch
+BATCH_SIZE = 100
+
+# Maximum time (in seconds) the first message of a batch waits for more messages
+BATCH_WAIT = 0.2
+
+
+
+# ------------- Micro-batch consumer ------------- #
+
+class MicroBatchConsumer:
+
+    def __init__(self, connection, channel, queue, handle_batch, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.connection = connection
+        self.channel = channel
+        self.queue = queue
+        self.handle_batch = handle_batch
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        # Deliveries of the current batch and the timer that flushes it
+        self.pending = []
+        self.timer = None
+
+        self.channel.basic_qos(prefetch_count=batch_size)
+        self.channel.basic_consume(queue=queue, on_message_callback=self.on_receive_message, auto_ack=False)
+
+
+    def on_receive_message(self, ch, method, properties, body):
+        self.pending.append((method, properties, body))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.connection.call_later(self.batch_wait, self.on_timer)
+
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+
+    def flush(self):
+        # Hands the current batch over to handle_batch and acknowledges or rejects all of its messages at once
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = []
+        last_delivery_tag = batch[-1][0].delivery_tag
+
+        try:
+            self.handle_batch(batch)
+        except Exception as e:
+            print(f"Error occurred while processing a batch of {len(batch)} messages: {e}")
+            self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True, requeue=True)
+            print(f"Requeued {len(batch)} messages up to {last_delivery_tag}")
+            return
+
+        self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+        print(f"Acknowledged {len(batch)} messages up to {last_delivery_tag}")
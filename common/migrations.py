@@ -0,0 +1,316 @@
+"""
+This module is copied into every container that uses one of the PostgreSQL databases.
+
+The 'init.sql' files only create the initial tables. Everything that is added to the schemas afterwards is defined
+here as a list of numbered migrations per database, which the services apply on startup:
+
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_2_EPLF)
+
+The applied versions are recorded in the 'schema_migrations' table, so every migration runs exactly once per database.
+As several containers share a database and start at the same time, the migrations are applied under an advisory lock.
+"""
+
+
+# Key of the advisory lock that is held while migrating (advisory locks are scoped to a single database)
+MIGRATION_LOCK_KEY = 20230601
+
+# Number of payment ids per range of the 'LogDigest' table (changing it requires a migration that rebuilds the table)
+DIGEST_RANGE_SIZE = 1000
+
+
+
+# ------------- Migrations ------------- #
+
+# Each migration is a tuple of (version, description, SQL statements)
+
+# Removes duplicate rows of a log table (keeping the oldest one) so a unique index can be created on 'payment_id'
+_REMOVE_DUPLICATE_LOG_ROWS = """
+    DELETE FROM {table} AS duplicate
+    USING {table} AS original
+    WHERE duplicate.payment_id = original.payment_id
+    AND duplicate.id > original.id
+"""
+
+# Table holding the high-water mark of the EPLF publisher: the id of the last payment that was written to 'Log'.
+# It is started at the highest logged payment, as the publishers used to pick the payments in the order of their ids.
+_CREATE_PUBLISH_CURSOR = [
+    """
+    CREATE TABLE IF NOT EXISTS PublishCursor (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_payment_id INTEGER NOT NULL
+    )
+    """,
+    """
+    INSERT INTO PublishCursor (id, last_payment_id)
+    SELECT 1, COALESCE(MAX(payment_id), 0) FROM Log
+    ON CONFLICT (id) DO NOTHING
+    """,
+]
+
+# Time at which the broker confirmed the message containing a Log row, NULL while the row is still in flight.
+# The rows that existed before were published without confirms, they are counted as published when they were inserted.
+_ADD_PUBLISHED_AT = [
+    "ALTER TABLE Log ADD COLUMN IF NOT EXISTS published_at TIMESTAMP",
+    "UPDATE Log SET published_at = inserted WHERE published_at IS NULL",
+]
+
+# Statement level trigger that notifies the listening publishers about new payments.
+# The payload is the number of inserted rows, so the publishers know how many rows to fetch.
+_CREATE_PAYMENTS_NOTIFY_TRIGGER = [
+    """
+    CREATE OR REPLACE FUNCTION notify_new_payments() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('new_payments', (SELECT count(*) FROM new_rows)::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS payments_notify ON Payments",
+    """
+    CREATE TRIGGER payments_notify
+    AFTER INSERT ON Payments
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_new_payments()
+    """,
+]
+
+# Replaces the trigger above with one that only wakes up the listening publishers when new payments are inserted.
+# The notification has no payload: PostgreSQL folds identical notifications of a transaction into one,
+# so it can't tell how many rows were inserted, and the publishers read all new payments anyway.
+_CREATE_PAYMENTS_WAKE_UP_TRIGGER = [
+    """
+    CREATE OR REPLACE FUNCTION notify_new_payments() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('new_payments', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS payments_notify ON Payments",
+    """
+    CREATE TRIGGER payments_notify
+    AFTER INSERT ON Payments
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_new_payments()
+    """,
+]
+
+# Time at which the republish service last resent a Log row, so it only resends rows that became due since then
+_ADD_LAST_REPUBLISHED_AT = "ALTER TABLE Log ADD COLUMN IF NOT EXISTS last_republished_at TIMESTAMP"
+
+# Retry schedule of the republish service: number of resends, time of the next resend and time the row was parked at.
+# New rows are due 120 seconds after their insertion, the rows that already exist keep their current schedule.
+# The index on the due rows replaces the one of migration 6.
+_ADD_RETRY_SCHEDULE = [
+    "ALTER TABLE Log ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE Log ADD COLUMN IF NOT EXISTS next_retry_at TIMESTAMP",
+    "ALTER TABLE Log ADD COLUMN IF NOT EXISTS parked_at TIMESTAMP",
+    "ALTER TABLE Log ALTER COLUMN next_retry_at SET DEFAULT (now() AT TIME ZONE 'UTC') + interval '120 seconds'",
+    """
+    UPDATE Log SET next_retry_at = COALESCE(last_republished_at, inserted) + interval '120 seconds'
+    WHERE validated = false AND next_retry_at IS NULL
+    """,
+    "DROP INDEX IF EXISTS log_republish_due_idx",
+]
+
+# Time until which a Log row is expected to be in the 'data' queue or in processing by the ZD,
+# the republish service doesn't resend rows whose lease hasn't run out yet
+_ADD_LEASED_UNTIL = "ALTER TABLE Log ADD COLUMN IF NOT EXISTS leased_until TIMESTAMP"
+
+# Whether the validation service has sent a 'Log' row to the validator in a snapshot, so delta snapshots contain
+# every row that hasn't been sent yet, no matter in which order the rows were committed
+_ADD_SNAPSHOT_SENT = [
+    "ALTER TABLE Log ADD COLUMN IF NOT EXISTS snapshot_sent BOOLEAN NOT NULL DEFAULT false",
+    "CREATE INDEX IF NOT EXISTS log_unsent_idx ON Log (id) WHERE validated = false AND snapshot_sent = false",
+]
+
+# Digests of the unvalidated 'Log' rows per range of DIGEST_RANGE_SIZE payment ids, compared by the validator.
+# The digest of a range is the XOR of the hashes of its unvalidated rows, so a trigger can add and remove rows
+# without reading the rest of the range. The trigger only appends the changes of each statement to 'LogDigest',
+# which avoids row locks on the hot path; the validation services sum the appended rows up when they read the digests.
+_CREATE_LOG_DIGEST = [
+    """
+    CREATE OR REPLACE FUNCTION log_row_hash(payment_id INTEGER, iban TEXT) RETURNS BIGINT AS $$
+        SELECT hashtextextended(payment_id::text || ':' || iban, 0)
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS LogDigest (
+        bucket INTEGER NOT NULL,
+        row_count BIGINT NOT NULL,
+        digest BIGINT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS logdigest_bucket_idx ON LogDigest (bucket)",
+    f"""
+    INSERT INTO LogDigest (bucket, row_count, digest)
+    SELECT payment_id / {DIGEST_RANGE_SIZE}, count(*), bit_xor(log_row_hash(payment_id, iban))
+    FROM Log
+    WHERE validated = false
+    GROUP BY 1
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION log_digest_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO LogDigest (bucket, row_count, digest)
+            SELECT changes.payment_id / {DIGEST_RANGE_SIZE}, sum(changes.row_count), bit_xor(log_row_hash(changes.payment_id, changes.iban))
+            FROM old_rows o
+            JOIN new_rows n ON n.id = o.id
+            CROSS JOIN LATERAL (VALUES (o.payment_id, o.iban, o.validated, -1), (n.payment_id, n.iban, n.validated, 1))
+                AS changes (payment_id, iban, validated, row_count)
+            WHERE (o.payment_id, o.iban, o.validated) IS DISTINCT FROM (n.payment_id, n.iban, n.validated)
+            AND changes.validated = false
+            GROUP BY 1;
+        ELSIF TG_OP = 'INSERT' THEN
+            INSERT INTO LogDigest (bucket, row_count, digest)
+            SELECT payment_id / {DIGEST_RANGE_SIZE}, count(*), bit_xor(log_row_hash(payment_id, iban))
+            FROM new_rows
+            WHERE validated = false
+            GROUP BY 1;
+        ELSE
+            INSERT INTO LogDigest (bucket, row_count, digest)
+            SELECT payment_id / {DIGEST_RANGE_SIZE}, -count(*), bit_xor(log_row_hash(payment_id, iban))
+            FROM old_rows
+            WHERE validated = false
+            GROUP BY 1;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS log_digest_insert ON Log",
+    "DROP TRIGGER IF EXISTS log_digest_update ON Log",
+    "DROP TRIGGER IF EXISTS log_digest_delete ON Log",
+    """
+    CREATE TRIGGER log_digest_insert
+    AFTER INSERT ON Log
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_digest_changed()
+    """,
+    """
+    CREATE TRIGGER log_digest_update
+    AFTER UPDATE ON Log
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_digest_changed()
+    """,
+    """
+    CREATE TRIGGER log_digest_delete
+    AFTER DELETE ON Log
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_digest_changed()
+    """,
+]
+
+CONCEPT_1_EPLF = [
+    (1, "unique index on Log.payment_id", [
+        _REMOVE_DUPLICATE_LOG_ROWS.format(table='Log'),
+        "CREATE UNIQUE INDEX IF NOT EXISTS log_payment_id_key ON Log (payment_id)",
+    ]),
+    (2, "partial index on the unvalidated and not faulty rows of Log", [
+        "CREATE INDEX IF NOT EXISTS log_unvalidated_inserted_idx ON Log (inserted) WHERE validated = false AND faulty = false",
+    ]),
+    (3, "high-water mark of the publisher", _CREATE_PUBLISH_CURSOR),
+    (4, "publish confirmation time of the Log rows", _ADD_PUBLISHED_AT),
+    (5, "notification about new payments", _CREATE_PAYMENTS_NOTIFY_TRIGGER),
+    (6, "republish time of the Log rows and index on the rows that are due to be resent", [
+        _ADD_LAST_REPUBLISHED_AT,
+        "CREATE INDEX IF NOT EXISTS log_republish_due_idx ON Log ((COALESCE(last_republished_at, inserted))) "
+        "WHERE validated = false AND faulty = false",
+    ]),
+    (7, "retry schedule of the Log rows", _ADD_RETRY_SCHEDULE + [
+        "CREATE INDEX IF NOT EXISTS log_retry_due_idx ON Log (next_retry_at) "
+        "WHERE validated = false AND faulty = false AND parked_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS log_parked_idx ON Log (parked_at) WHERE validated = false AND parked_at IS NOT NULL",
+    ]),
+    (8, "lease of the Log rows that are in flight", [_ADD_LEASED_UNTIL]),
+    (9, "notification about new payments without payload", _CREATE_PAYMENTS_WAKE_UP_TRIGGER),
+]
+
+CONCEPT_1_ZD = []
+
+CONCEPT_2_EPLF = [
+    (1, "unique index on Log.payment_id", [
+        _REMOVE_DUPLICATE_LOG_ROWS.format(table='Log'),
+        "CREATE UNIQUE INDEX IF NOT EXISTS log_payment_id_key ON Log (payment_id)",
+    ]),
+    (2, "partial index on the unvalidated rows of Log", [
+        "CREATE INDEX IF NOT EXISTS log_unvalidated_inserted_idx ON Log (inserted) WHERE validated = false",
+    ]),
+    (3, "high-water mark of the publisher", _CREATE_PUBLISH_CURSOR),
+    (4, "publish confirmation time of the Log rows", _ADD_PUBLISHED_AT),
+    (5, "notification about new payments", _CREATE_PAYMENTS_NOTIFY_TRIGGER),
+    (6, "republish time of the Log rows and index on the rows that are due to be resent", [
+        _ADD_LAST_REPUBLISHED_AT,
+        "CREATE INDEX IF NOT EXISTS log_republish_due_idx ON Log ((COALESCE(last_republished_at, inserted))) "
+        "WHERE validated = false",
+    ]),
+    (7, "retry schedule of the Log rows", _ADD_RETRY_SCHEDULE + [
+        "CREATE INDEX IF NOT EXISTS log_retry_due_idx ON Log (next_retry_at) WHERE validated = false AND parked_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS log_parked_idx ON Log (parked_at) WHERE validated = false AND parked_at IS NOT NULL",
+    ]),
+    (8, "lease of the Log rows that are in flight", [_ADD_LEASED_UNTIL]),
+    (9, "digests of the unvalidated Log rows per payment id range", _CREATE_LOG_DIGEST),
+    (10, "notification about new payments without payload", _CREATE_PAYMENTS_WAKE_UP_TRIGGER),
+    (11, "snapshot state of the Log rows", _ADD_SNAPSHOT_SENT),
+]
+
+CONCEPT_2_ZD = [
+    (1, "unique indexes on Log.payment_id and InvalidLog.payment_id", [
+        _REMOVE_DUPLICATE_LOG_ROWS.format(table='Log'),
+        _REMOVE_DUPLICATE_LOG_ROWS.format(table='InvalidLog'),
+        "CREATE UNIQUE INDEX IF NOT EXISTS log_payment_id_key ON Log (payment_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS invalidlog_payment_id_key ON InvalidLog (payment_id)",
+    ]),
+    (2, "partial index on the unvalidated rows of Log", [
+        "CREATE INDEX IF NOT EXISTS log_unvalidated_inserted_idx ON Log (inserted) WHERE validated = false",
+    ]),
+    (3, "digests of the unvalidated Log rows per payment id range", _CREATE_LOG_DIGEST),
+    (4, "snapshot state of the Log rows", _ADD_SNAPSHOT_SENT),
+]
+
+
+
+# ------------- Migration functions ------------- #
+
+def apply_migrations(conn, migrations):
+    # Applies all migrations that have not been applied to the database yet, each one in its own transaction.
+    # Returns the list of applied versions.
+    cursor = conn.cursor()
+    applied_versions = []
+
+    # Wait until no other container is migrating, the lock is released at the end of the transaction
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+        )
+    """)
+    conn.commit()
+
+    for version, description, statements in migrations:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+
+        cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+
+        if cursor.fetchone():
+            conn.rollback()
+            continue
+
+        for statement in statements:
+            cursor.execute(statement)
+
+        cursor.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+            (version, description)
+        )
+        conn.commit()
+
+        applied_versions.append(version)
+        print(f"Applied migration {version}: {description}")
+
+    return applied_versions
@@ -0,0 +1,92 @@
+"""
+This module is copied into every concept 2 container that declares the RabbitMQ 'data' queue.
+
+Besides the 'data' queue itself, two more queues take the payloads the ZD can't process, so the ZD listener
+doesn't spend its time on them over and over again:
+
+    - 'data-dead-letter': messages the ZD listener rejected (RabbitMQ moves them there via the dead letter exchange
+      given in the arguments of the 'data' queue) and rows that failed for a reason that may go away (system errors).
+      They are put back into the 'data' queue until they have failed MAX_DEATHS times.
+    - 'data-parking-lot': rows that will never succeed (invalid IBANs, malformed rows) and messages that failed
+      MAX_DEATHS times. They are never put back into the 'data' queue.
+
+Both queues are drained by the low-priority dead_letter.py consumer of the ZD.
+As the arguments of a queue can't change once it exists, every container has to declare the queues with this module:
+
+    declare_data_queues(channel)
+"""
+
+
+DATA_QUEUE = 'data'
+DEAD_LETTER_EXCHANGE = 'data-dead-letter'
+DEAD_LETTER_QUEUE = 'data-dead-letter'
+PARKING_LOT_QUEUE = 'data-parking-lot'
+
+# Number of times a payload may fail before it is moved to the parking lot
+MAX_DEATHS = 3
+
+# Header counting how often the rows of a message failed inside the ZD listener without the message being rejected
+# (RabbitMQ only counts rejected messages in the 'x-death' header)
+RETRY_COUNT_HEADER = 'x-retry-count'
+
+# Header stating why a message was dead-lettered or parked by one of the services
+REASON_HEADER = 'x-reason'
+
+
+
+# ------------- Declaration functions ------------- #
+
+def declare_data_queues(channel):
+    # Declares the 'data' queue together with its dead letter exchange, dead letter queue and parking lot
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='direct')
+
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE)
+    channel.queue_bind(queue=DEAD_LETTER_QUEUE, exchange=DEAD_LETTER_EXCHANGE, routing_key=DEAD_LETTER_QUEUE)
+
+    channel.queue_declare(queue=PARKING_LOT_QUEUE)
+
+    # Rejected messages (basic_nack / basic_reject without requeue) are moved to the dead letter queue
+    channel.queue_declare(queue=DATA_QUEUE, arguments={
+        'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE,
+        'x-dead-letter-routing-key': DEAD_LETTER_QUEUE,
+    })
+
+
+
+# ------------- Header functions ------------- #
+
+def death_count(properties):
+    # Returns how often the payload of a message has failed so far:
+    # the number of times RabbitMQ dead-lettered it out of the 'data' queue (taken from the 'x-death' header)
+    # plus the number of times its rows failed inside the ZD listener
+    headers = properties.headers if properties and properties.headers else {}
+    deaths = sum(
+        death.get('count', 1)
+        for death in headers.get('x-death', [])
+        if death.get('queue') == DATA_QUEUE
+    )
+
+    return deaths + headers.get(RETRY_COUNT_HEADER, 0)
+
+
+def failure_headers(properties, reason):
+    # Returns the headers for dead-lettering rows of a message that failed inside the ZD listener for the given reason.
+    # The failure history of the original message is kept and counts one more failure.
+    headers = dict(properties.headers) if properties and properties.headers else {}
+    headers[REASON_HEADER] = reason
+    headers[RETRY_COUNT_HEADER] = death_count(properties) + 1
+    headers.pop('x-death', None)
+
+    return headers
+
+
+def retry_headers(properties):
+    # Returns the headers for putting a dead-lettered message back into the 'data' queue.
+    # The deaths counted by RabbitMQ are carried over into our own header, which doesn't depend on the broker
+    # updating an 'x-death' header that was set by a publisher.
+    headers = dict(properties.headers) if properties and properties.headers else {}
+    headers[RETRY_COUNT_HEADER] = death_count(properties)
+    headers.pop('x-death', None)
+    headers.pop(REASON_HEADER, None)
+
+    return headers
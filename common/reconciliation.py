@@ -0,0 +1,162 @@
+"""
+This module is copied into the validator-listen container, which compares the unvalidated rows of the EPLF and the ZD.
+
+Instead of comparing every EPLF row with every ZD row (O(n·m)), the validator compares incrementally with a
+ReconciliationStore, which keeps the unmatched rows of both sides indexed by 'payment_id' between the rounds.
+Every arriving row is probed against the other side and either matched right away or kept, so the work per round
+is proportional to the rows that arrive, not to the whole backlog:
+
+    store = ReconciliationStore()
+
+    matches, mismatches = store.add(EPLF, rows)
+    store.expire()
+
+'matches' are the rows both sides now hold identically, 'mismatches' the (EPLF row, ZD row) pairs of payments
+whose rows differ. The rows are the lists sent by the validation services, with the 'payment_id' as their first field.
+
+Rows that haven't been seen again for STORE_TTL seconds are dropped by expire(), which classifies them by what
+the other side held for the same payment and returns them per class:
+
+    expired = store.expire()
+
+    expired[MISSING_IN_ZD]    EPLF rows without a ZD row for their payment
+    expired[MISSING_IN_EPLF]  ZD rows without an EPLF row for their payment
+    expired[FIELD_MISMATCH]   (EPLF row, ZD row) pairs of the same payment that differ in another field
+
+Together with the matched rows (MATCHED), the store counts every class over its lifetime, see format_summary().
+
+In a digest round the services don't send rows but one [bucket, row_count, digest] per range of payment ids
+(see migrations.py). compare_digests splits the ranges into those that are equal on both sides and the buckets
+whose rows differ, so only the rows of the differing ranges have to be sent:
+
+    equal_ranges, differing_buckets = compare_digests(eplf_digests, zd_digests)
+"""
+
+
+import time
+from collections import OrderedDict
+
+
+# Unmatched rows are dropped if they haven't been received again for this many seconds
+STORE_TTL = 3600
+
+EPLF = 'eplf'
+ZD = 'zd'
+
+MATCHED = 'matched'
+MISSING_IN_ZD = 'missing_in_zd'
+MISSING_IN_EPLF = 'missing_in_eplf'
+FIELD_MISMATCH = 'field_mismatch'
+
+
+
+# ------------- Digest functions ------------- #
+
+def compare_digests(eplf_digests, zd_digests):
+    # Returns the [bucket, row_count, digest] of the ranges that are equal on both sides
+    # and the sorted buckets of the ranges that differ or only exist on one side
+    zd_index = {bucket: (row_count, digest) for bucket, row_count, digest in zd_digests}
+
+    equal_ranges = []
+    differing_buckets = set(zd_index)
+
+    for bucket, row_count, digest in eplf_digests:
+        if zd_index.get(bucket) == (row_count, digest):
+            equal_ranges.append([bucket, row_count, digest])
+            differing_buckets.discard(bucket)
+        else:
+            differing_buckets.add(bucket)
+
+    return equal_ranges, sorted(differing_buckets)
+
+
+
+# ------------- Incremental reconciliation ------------- #
+
+class ReconciliationStore:
+
+    def __init__(self, ttl=STORE_TTL):
+        self.ttl = ttl
+
+        # Unmatched rows of each side: payment_id -> (row, time the row was last received),
+        # ordered by the time the row was last received so the oldest rows can be expired first
+        self.rows = {EPLF: OrderedDict(), ZD: OrderedDict()}
+
+        # Number of payments per class over the lifetime of the store
+        self.counts = {MATCHED: 0, MISSING_IN_ZD: 0, MISSING_IN_EPLF: 0, FIELD_MISMATCH: 0}
+
+
+    def add(self, side, rows, now=None):
+        # Merges rows of one side into the store and probes them against the other side.
+        # Returns the rows that are now held identically by both sides (and removes them from the store)
+        # and the (EPLF row, ZD row) pairs of payments whose rows differ.
+        now = time.monotonic() if now is None else now
+        own_rows = self.rows[side]
+        other_rows = self.rows[ZD if side == EPLF else EPLF]
+
+        matches = []
+        mismatches = []
+
+        for row in rows:
+            payment_id = row[0]
+            other = other_rows.get(payment_id)
+
+            if other is not None and other[0] == row:
+                matches.append(row)
+                del other_rows[payment_id]
+                own_rows.pop(payment_id, None)
+                continue
+
+            if other is not None:
+                mismatches.append((row, other[0]) if side == EPLF else (other[0], row))
+
+            # Keep the row (or refresh the time it was last received) until the other side holds the same row
+            own_rows[payment_id] = (row, now)
+            own_rows.move_to_end(payment_id)
+
+        self.counts[MATCHED] += len(matches)
+
+        return matches, mismatches
+
+
+    def expire(self, now=None):
+        # Drops the rows that haven't been received again for longer than the TTL and classifies them:
+        # a row the other side doesn't hold is missing there, a payment both sides hold with different rows
+        # is a field mismatch (both rows are dropped together). Returns the dropped rows per class.
+        now = time.monotonic() if now is None else now
+        expired = {MISSING_IN_ZD: [], MISSING_IN_EPLF: [], FIELD_MISMATCH: []}
+
+        for side, other_side, missing in ((EPLF, ZD, MISSING_IN_ZD), (ZD, EPLF, MISSING_IN_EPLF)):
+            side_rows = self.rows[side]
+            other_rows = self.rows[other_side]
+
+            while side_rows:
+                payment_id, (row, received_at) = next(iter(side_rows.items()))
+
+                if now - received_at <= self.ttl:
+                    break
+
+                del side_rows[payment_id]
+                other = other_rows.pop(payment_id, None)
+
+                if other is None:
+                    expired[missing].append(row)
+                else:
+                    expired[FIELD_MISMATCH].append((row, other[0]) if side == EPLF else (other[0], row))
+
+        for name, rows in expired.items():
+            self.counts[name] += len(rows)
+
+        return expired
+
+
+    def format_summary(self):
+        # Returns a one-line summary of the unmatched rows and of the number of payments in each class
+        classes = ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in self.counts.items())
+
+        return f"{len(self.rows[EPLF])} unmatched EPLF rows, {len(self.rows[ZD])} unmatched ZD rows, {classes} in total"
+
+
+def format_expired(expired):
+    # Returns a one-line summary of the rows dropped by ReconciliationStore.expire()
+    return ", ".join(f"{len(rows)} {name.replace('_', ' ')}" for name, rows in expired.items())
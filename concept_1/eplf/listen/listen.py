@@ -5,38 +5,65 @@ It listens for messages on the 'validation' queue and iterates through the data
 
 For each record in the message, it updates the corresponding entry in the 'Log' table to have the 'validated' field set to True
 and the `faulty` field set to True if the IBAN is invalid.
+
+All payment ids of a message are sent as a single array parameter and updated with one statement,
+instead of one UPDATE per row (see benchmarks/validation_update_benchmark.py).
+The messages are consumed in micro-batches (see micro_batch.py): the updates of all messages of a batch are committed
+in one transaction and the messages are acknowledged together.
 """
 
 
-import json
 from datetime import datetime
 import pika
-import psycopg2
+from database import ConnectionPool
+from migrations import apply_migrations, CONCEPT_1_EPLF
+from codec import decode_message
+from micro_batch import MicroBatchConsumer
+
+
+# Update the rows of a message with one set-based UPDATE instead of one UPDATE per row
+BULK_UPDATE = True
+
+
+# Pool of connections to the EPLF database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
 
 
 
 # ------------- Database / data functions ------------- #
 
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
-        )
-        print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
+def bulk_update_log(cursor, column, payment_ids):
+    # Sets the given boolean column to True for all the payments with a single statement.
+    # Returns the number of updated rows.
+    if not payment_ids:
+        return 0
+
+    cursor.execute(
+        f"""
+        UPDATE Log SET {column} = True
+        FROM unnest(%s::int[]) AS ids(payment_id)
+        WHERE Log.payment_id = ids.payment_id
+        """,
+        (payment_ids,)
+    )
+
+    return cursor.rowcount
 
 
 def update_db(data, cursor):
+    # Returns the number of updated rows of the 'Log' table
     type_of_data = data["type"]
     data = data["data"]
 
+    if BULK_UPDATE:
+        column = {"successful_insertion": "validated", "invalid_iban": "faulty"}.get(type_of_data)
+        updated_rows = bulk_update_log(cursor, column, [row[0] for row in data]) if column else 0
+
+        print(f"Updated {updated_rows} of {len(data)} records in the 'Log' table of the EPLF database to be validated or faulty. \n")
+        return updated_rows
+
+    updated_rows = 0
+
     # check the received dictionary for the type of data
     if type_of_data == "successful_insertion":
 
@@ -50,6 +77,7 @@ def update_db(data, cursor):
                 "UPDATE Log SET validated = True WHERE payment_id = %s",
                 (payment_id,)
             )
+            updated_rows += cursor.rowcount
 
     elif type_of_data == "invalid_iban":
 
@@ -63,43 +91,45 @@ def update_db(data, cursor):
                 "UPDATE Log SET faulty = True WHERE payment_id = %s",
                 (payment_id,)
             )
+            updated_rows += cursor.rowcount
 
 
-    print(f"Updated {len(data)} records in the 'Log' table of the EPLF database to be validated or faulty. \n")
+    print(f"Updated {updated_rows} of {len(data)} records in the 'Log' table of the EPLF database to be validated or faulty. \n")
 
+    return updated_rows
 
 
-# ------------- Message Queue functions ------------- #
 
-def on_receive_message(ch, method, properties, body):
-    # Decode the JSON string back into a Python list
-    data = json.loads(body)
+# ------------- Message Queue functions ------------- #
 
-    # Connect to the database
-    conn = connect_to_db(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
+def handle_batch(batch):
+    # Applies the updates of all messages of the batch in a single transaction.
+    # The messages are acknowledged by the MicroBatchConsumer afterwards, or requeued if this raises.
 
-    if conn:
+    # Check out a connection from the pool, it is returned automatically (and rolled back if this raises) when done
+    with db_pool.connection() as conn:
         # Create a cursor from the connection
         cursor = conn.cursor()
 
-        # Update the Log table in the database
-        update_db(data, cursor)
+        for method, properties, body in batch:
+            # Decode the message back into a Python dictionary based on its content type
+            data = decode_message(body, properties)
 
-        # Commit the changes
-        conn.commit()
-
-        # Close the connection
-        conn.close()
+            # Update the Log table in the database
+            update_db(data, cursor)
 
-        # Acknowledge message so it can be removed from the queue
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        print(f"Message acknowledged: {method.delivery_tag}")
+        # Commit the changes of the whole batch
+        conn.commit()
 
 
 
 # ------------- Main function ------------- #
 
 def main():
+    # Bring the schema of the EPLF database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_1_EPLF)
+
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
 
@@ -110,8 +140,8 @@ def main():
     # Declare the queue from which to receive messages
     channel.queue_declare(queue='validation')
 
-    # Declare the callback function
-    channel.basic_consume(queue='validation', on_message_callback=on_receive_message, auto_ack=False)
+    # Consume the messages in micro-batches
+    MicroBatchConsumer(connection, channel, 'validation', handle_batch)
 
     print('Waiting for messages. To exit press CTRL+C')
 
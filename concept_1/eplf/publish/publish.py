@@ -1,61 +1,120 @@
 """
 This script is run inside the EPLF-publish container.
 
-This script retrieves a random number of rows (between 1000 and 10000) from the 'Payments' table of the EPLF database
-that have not already been retrieved previously (and are therefore not present in the 'Log' table).
-
-The retrieved rows are then added to the 'Log' table in the database, converted to a JSON string and published to the RabbitMQ 'data' queue.
-
-It runs in a loop with a 10 minute delay between each iteration.
+This script retrieves rows from the 'Payments' table of the EPLF database that have not already been retrieved previously.
+The number of rows per batch is chosen by a FlowController (see flow_control.py) based on the backlog of the 'data' queue.
+The id of the last retrieved payment is kept as a high-water mark in the 'PublishCursor' table,
+so every iteration reads the next rows in the order of their ids.
+Payment ids are handed out by a sequence, so a payment can commit after payments with higher ids have already been
+published. Every iteration therefore also picks up the payments without a 'Log' row in the CATCH_UP_WINDOW ids below
+the mark. On startup, the whole range below the mark is checked once, which also covers payments that were left
+behind before the mark existed.
+
+The retrieved rows are then added to the 'Log' table in the database, encoded (see codec.py) and published to the RabbitMQ 'data' queue.
+
+The channel is in publisher confirm mode. The Log rows are written as "in flight" ('published_at' is NULL) and
+only marked as published once the broker has confirmed the message. A message the broker rejects is
+published again right away instead of waiting for the republish service.
+Published rows are leased for the time the FlowController expects them to spend in the queue ('leased_until'),
+so the republish service doesn't resend them while the ZD is still working through the backlog.
+If the connection or the channel to RabbitMQ is lost while publishing, the in flight rows that were not confirmed
+are released again (their Log rows are deleted), so the publisher picks them up right after it has reconnected.
+
+Besides the periodic run every 10 minutes, the publisher LISTENs for the notifications a trigger on 'Payments'
+sends for every insert (see migrations.py). A notification is only a wake-up signal (PostgreSQL folds identical
+notifications of a transaction into one), so the publisher waits MAX_WAIT seconds for the rest of a burst and then
+publishes pages of at most MAX_BATCH_SIZE rows until a page comes back shorter than requested.
+The periodic run drains the payments the same way and stays as a safety net for notifications that got lost,
+e.g. while the publisher was restarting.
 """
 
-import json
 import time
-import random
+import select
 import pika
+import pika.exceptions
 import psycopg2
 from schwifty import IBAN
 from schwifty.exceptions import InvalidChecksumDigits
+from database import ConnectionPool, connect_to_db
+from migrations import apply_migrations, CONCEPT_1_EPLF
+from codec import encode_message, PAYMENTS_SCHEMA
+from flow_control import FlowController
 
 
+# Number of times a message is published before it is left to the republish service
+PUBLISH_ATTEMPTS = 3
 
-# ------------- Database / data functions ------------- #
+# Seconds to wait before reconnecting to RabbitMQ after the connection or the channel was lost
+RECONNECT_DELAY = 5
 
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
-        )
-        print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
+# Publish new payments as soon as they are announced by the trigger on 'Payments' instead of only every 10 minutes
+EVENT_DRIVEN = True
+
+# Name of the channel the trigger on 'Payments' notifies
+NOTIFY_CHANNEL = 'new_payments'
+
+# Seconds to wait after the first notification for the rest of a burst of inserts
+MAX_WAIT = 0.5
+
+# Maximum number of payments per page, the pages are published until one comes back shorter than requested
+MAX_BATCH_SIZE = 5000
+
+# Number of ids below the high-water mark that every iteration checks for payments that committed after the mark had passed them
+CATCH_UP_WINDOW = 10000
 
+# Seconds between the periodic runs, which also publish the payments whose notification got lost
+SWEEP_INTERVAL = 600
 
-def get_data_from_db(conn):
-    # This function retrieves a random number of rows (between 1000 and 10000) from the 'Payments' table in the database
-    # that have not already been retrieved previously (and are therefore not in the 'Log' table)
+
+# Pool of connections to the EPLF database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
+
+
+
+# ------------- Database / data functions ------------- #
+
+def get_data_from_db(conn, num_rows_to_retrieve, catch_up_window=CATCH_UP_WINDOW):
+    # This function retrieves the given number of rows from the 'Payments' table in the database
+    # that have not already been retrieved previously: first the payments without a 'Log' row in the 'catch_up_window' ids
+    # below the high-water mark (all of them if it is None), then the payments that come after the mark.
+    # The row of the mark stays locked until write_data_to_db commits, so the rows can't be handed out twice.
     cursor = conn.cursor()
 
-    num_rows_to_retrieve = random.randint(1000, 10000)
+    cursor.execute("SELECT last_payment_id FROM PublishCursor WHERE id = 1 FOR UPDATE")
+    last_payment_id = cursor.fetchone()[0]
+
+    # Payments that committed after the mark had already passed their id
+    catch_up_from = 0 if catch_up_window is None else max(last_payment_id - catch_up_window, 0)
+
+    cursor.execute("""
+        SELECT p.id, p.amount, p.iban, TO_CHAR(p.payment_date, 'YYYY-MM-DD')
+        FROM Payments p
+        WHERE p.id > %s
+        AND p.id <= %s
+        AND NOT EXISTS (SELECT 1 FROM Log l WHERE l.payment_id = p.id)
+        ORDER BY p.id
+        LIMIT %s
+    """, (catch_up_from, last_payment_id, num_rows_to_retrieve))
+    data = cursor.fetchall()
+
+    if data:
+        print(f"Found {len(data)} payments below the high-water mark {last_payment_id} that have not been published yet.")
 
-    cursor.execute(f"""
+    # Keyset pagination on the primary key, which costs the same no matter how many payments were published before
+    cursor.execute("""
         SELECT id, amount, iban, TO_CHAR(payment_date, 'YYYY-MM-DD')
         FROM Payments
-        WHERE id NOT IN (SELECT payment_id FROM Log)
-        LIMIT {num_rows_to_retrieve}
-    """)
-    return cursor.fetchall()
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+    """, (last_payment_id, num_rows_to_retrieve - len(data)))
+    return data + cursor.fetchall()
 
 
 def write_data_to_db(conn, data):
-    # This function writes the data to the 'Log' table in the database
-    # It checks beforehand if the IBAN is valid, and if not, it sets the 'faulty' column to True
+    # This function writes the data to the 'Log' table in the database and advances the high-water mark
+    # to the last retrieved payment (unless all of them were below it), both in the same transaction as get_data_from_db.
+    # The rows are in flight until mark_as_published is called for them.
 
     cursor = conn.cursor()
 
@@ -69,16 +128,128 @@ def write_data_to_db(conn, data):
             (payment_id, iban)
         )
 
+    if data:
+        cursor.execute("UPDATE PublishCursor SET last_payment_id = GREATEST(last_payment_id, %s) WHERE id = 1", (data[-1][0],))
+
     conn.commit()
     print(f"Successfully added {len(data)} rows to the Log Table of the EPLF database.")
 
 
+def mark_as_published(conn, payment_ids, lease_time):
+    # This function marks the Log rows of the confirmed payments as published, all of them with a single statement.
+    # The rows are leased for 'lease_time' seconds, so the republish service doesn't resend them while they are still queued.
+    if not payment_ids:
+        return
 
-# ------------- Main function ------------- #
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE Log
+        SET published_at = now() AT TIME ZONE 'UTC',
+            leased_until = (now() AT TIME ZONE 'UTC') + make_interval(secs => %s)
+        WHERE payment_id = ANY(%s)
+        """,
+        (lease_time, payment_ids)
+    )
+    conn.commit()
+    print(f"Marked {cursor.rowcount} rows of the Log table as published.")
 
-def main():
-    # Connect to database
+
+def release_unconfirmed(conn, payment_ids):
+    # This function deletes the Log rows of payments that are still in flight because their message was never confirmed.
+    # The payments are then below the high-water mark without a Log row, so the catch-up of the next run publishes them again.
+    if not payment_ids:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM Log WHERE payment_id = ANY(%s) AND published_at IS NULL", (payment_ids,))
+    conn.commit()
+    print(f"Released {cursor.rowcount} unconfirmed rows of the Log table.")
+
+
+
+def open_listen_connection():
+    # This function opens a separate connection that LISTENs for new payments.
+    # It is not taken from the pool, as it has to stay in autocommit mode and keep listening between the runs.
     conn = connect_to_db(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
+    conn.autocommit = True
+    conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+    return conn
+
+
+def wait_for_new_payments(listen_conn, timeout):
+    # This function blocks until new payments are announced or the timeout (in seconds) expires.
+    # After the first notification it waits MAX_WAIT seconds more and discards the notifications of the same burst,
+    # as the publisher reads all new payments anyway. The payload of the notifications is not used.
+    # Returns True if new payments were announced, False if the timeout expired.
+    if not select.select([listen_conn], [], [], timeout)[0]:
+        return False
+
+    time.sleep(MAX_WAIT)
+
+    listen_conn.poll()
+    listen_conn.notifies.clear()
+
+    return True
+
+
+
+# ------------- Message Queue functions ------------- #
+
+def publish_with_confirm(channel, message, properties, attempts=PUBLISH_ATTEMPTS):
+    # This function publishes a message and waits for the broker to confirm it.
+    # Messages that are rejected (nack) or can't be routed to the queue are published again.
+    # Errors of the connection or the channel are raised, the caller has to release the rows and reconnect.
+    # Returns True once the message is confirmed, False if all attempts failed.
+    for attempt in range(1, attempts + 1):
+        try:
+            channel.basic_publish(exchange='', routing_key='data', body=message, properties=properties, mandatory=True)
+            return True
+        except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+            print(f"Attempt {attempt} of {attempts} to publish the message was not confirmed: {e!r}")
+
+    return False
+
+
+def publish_new_payments(channel, num_rows_to_retrieve, lease_time, catch_up_window=CATCH_UP_WINDOW):
+    # This function retrieves the next payments, logs them, publishes them as a single message and marks them once confirmed.
+    # Returns the number of retrieved payments.
+
+    # Check out a connection from the pool, it is returned automatically when done
+    with db_pool.connection() as conn:
+        # Retrieve data from database.
+        data = get_data_from_db(conn, num_rows_to_retrieve, catch_up_window)
+
+        # Write the IDs of the data that is about to be published into the 'Log' table in the database
+        write_data_to_db(conn, data)
+
+    if not data:
+        return 0
+
+    # Encode all data and send it as a single message
+    message, properties = encode_message(data, PAYMENTS_SCHEMA)
+
+    # Publish the message to the queue and flip its rows from in flight to published once it is confirmed,
+    # otherwise they are picked up by the republish service
+    try:
+        confirmed = publish_with_confirm(channel, message, properties)
+    except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+        # The confirm never arrived, release the rows so they are published again after reconnecting
+        with db_pool.connection() as conn:
+            release_unconfirmed(conn, [row[0] for row in data])
+        raise
+
+    if confirmed:
+        with db_pool.connection() as conn:
+            mark_as_published(conn, [row[0] for row in data], lease_time)
+
+    return len(data)
+
+
+def open_channel():
+    # This function connects to RabbitMQ and opens a channel in publisher confirm mode.
+    # Returns the connection and the channel.
 
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
@@ -90,27 +261,94 @@ def main():
     # Declare the queue from which to receive messages
     channel.queue_declare(queue='data')
 
-    sent_counter = 0
+    # Let the broker confirm every published message
+    channel.confirm_delivery()
+
+    return connection, channel
+
+
+def reconnect(connection):
+    # This function closes a connection to RabbitMQ that may already be broken and opens a new one,
+    # waiting RECONNECT_DELAY seconds between the attempts until the broker is reachable again.
+    # Returns the new connection and channel.
+    try:
+        if connection.is_open:
+            connection.close()
+    except pika.exceptions.AMQPError as e:
+        print(f"Could not close the connection to RabbitMQ: {e!r}")
 
     while True:
-        # Retrieve data from database.
-        data = get_data_from_db(conn)
+        time.sleep(RECONNECT_DELAY)
+        try:
+            return open_channel()
+        except pika.exceptions.AMQPConnectionError as e:
+            print(f"Could not reconnect to RabbitMQ: {e!r}, trying again in {RECONNECT_DELAY} seconds.")
 
-        # Write the IDs of the data that was published into the 'Log' table in the database
-        write_data_to_db(conn, data)
 
-        # Convert all data to a JSON string and send as a single message
-        message = json.dumps(data)
 
-        # Publish the message to the queue.
-        channel.basic_publish(exchange='', routing_key='data', body=message)
+# ------------- Main function ------------- #
+
+def main():
+    # Bring the schema of the EPLF database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_1_EPLF)
+
+    connection, channel = open_channel()
+
+    # Listen for new payments before the first run, so no insert in between is missed
+    listen_conn = open_listen_connection() if EVENT_DRIVEN else None
 
-        # Increment the counter.
-        sent_counter += len(data)
-        print(f"Sent {sent_counter} rows in total\n")
+    # Sizes the batches according to the backlog of the 'data' queue
+    flow_controller = FlowController(channel, 'data', rows_per_message=MAX_BATCH_SIZE)
 
-        # Wait 10 minutes before sending the next message.
-        time.sleep(600)
+    sent_counter = 0
+
+    # The first run checks the whole range below the high-water mark for payments that were left behind
+    catch_up_window = None
+
+    while True:
+        try:
+            # Publish the payments in pages of at most MAX_BATCH_SIZE rows, as many as the consumers can take,
+            # until a page comes back shorter than requested, i.e. all new payments have been published
+            while True:
+                batch_size = flow_controller.next_batch_size(MAX_BATCH_SIZE)
+
+                if batch_size == 0:
+                    # The consumers are behind (or there are none), give them time before publishing more
+                    time.sleep(flow_controller.pause_time())
+                    continue
+
+                published_rows = publish_new_payments(channel, batch_size, flow_controller.lease_time(batch_size), catch_up_window)
+                flow_controller.record_published(published_rows, 1)
+
+                # Increment the counter.
+                sent_counter += published_rows
+                print(f"Sent {sent_counter} rows in total")
+                print(f"Flow control: {flow_controller.metrics()}\n")
+
+                # All payments have been published
+                if published_rows < batch_size:
+                    break
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            # The unconfirmed rows were already released, reconnect and publish them again right away
+            print(f"Lost the connection to RabbitMQ: {e!r}, reconnecting.")
+            connection, channel = reconnect(connection)
+            flow_controller.channel = channel
+            continue
+
+        catch_up_window = CATCH_UP_WINDOW
+
+        if EVENT_DRIVEN:
+            # Wait for new payments, but at most until the next periodic run
+            try:
+                if wait_for_new_payments(listen_conn, SWEEP_INTERVAL):
+                    print("New payments were announced.")
+            except psycopg2.OperationalError as e:
+                print(f"Lost the connection listening for new payments: {e}")
+                listen_conn = open_listen_connection()
+        else:
+            # Wait 10 minutes before sending the next message.
+            time.sleep(SWEEP_INTERVAL)
 
 
 if __name__ == '__main__':
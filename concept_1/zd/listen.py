@@ -2,6 +2,7 @@
 This script listens to the 'data' queue and processes the incoming messages containing payment data.
 
 After validating the IBANs, it inserts the received data into the 'Payments' table of the ZD database.
+All rows of a message are written with a single set-based INSERT and committed in one transaction.
 
 The insertion has a random delay between 5ms and 50ms to simulate a real-world scenario.
 
@@ -14,43 +15,52 @@ If there were any rows with invalid IBANs, they will also be published to the 'v
 """
 
 
-import json
 import time
 import random
 from datetime import datetime
 import pika
 import psycopg2
 import psycopg2.errors
-from schwifty import IBAN
-from schwifty.exceptions import InvalidChecksumDigits
+from psycopg2.extras import execute_values
+from iban_validator import is_iban_valid, validate_ibans
+from database import ConnectionPool
+from migrations import apply_migrations, CONCEPT_1_ZD
+from codec import encode_message, decode_message, PAYMENTS_SCHEMA
+
+
+# Write the rows of a message with one set-based INSERT and a single commit
+# instead of one INSERT and one commit per row
+BULK_INSERT = True
+
+
+
+# Pool of connections to the ZD database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.24', dbname='db', user='postgres', password='postgres')
 
 
 
 # ------------- Database / data functions ------------- #
 
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
-        )
-        print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
-
-
-def is_iban_valid(iban):
-    # Returns True if the IBAN is valid, False otherwise
-    try:
-        iban = IBAN(iban)
-        return True
-    except InvalidChecksumDigits:
-        return False
+def bulk_insert_payments(cursor, rows):
+    # Inserts all rows with a single statement and returns the set of ids that were actually inserted.
+    # Ids that already exist in the 'Payments' table are skipped by the database instead of raising a UniqueViolation,
+    # so they are simply missing from the returned set.
+    if not rows:
+        return set()
+
+    inserted_rows = execute_values(
+        cursor,
+        """
+        INSERT INTO Payments (id, amount, iban, payment_date) VALUES %s
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+        """,
+        [(row[0], row[1], row[2], row[3]) for row in rows],
+        page_size=len(rows),
+        fetch=True
+    )
+
+    return {row[0] for row in inserted_rows}
 
 
 def insert_into_db(conn, data):
@@ -76,8 +86,15 @@ def insert_into_db(conn, data):
 
     # Check if data is list or single record
     if isinstance(data, list):
+        # Records that passed validation and still need to be written (only used when BULK_INSERT is set)
+        pending_data = []
+        pending_ids = set()
+
+        # Validate the IBANs of all records at once
+        iban_mask = validate_ibans(item[2] if len(item) >= 4 else None for item in data)
+
         # Loop through each record in list
-        for item in data:
+        for item, iban_is_valid in zip(data, iban_mask):
 
             # Validate the data item
             if len(item) < 4:
@@ -86,19 +103,30 @@ def insert_into_db(conn, data):
                 continue
 
             # Validate the IBAN
-            if not is_iban_valid(item[2]):
+            if not iban_is_valid:
                 invalid_iban_data.append(item)
                 continue
 
-            try:
-                # delay for a random duration
-                time.sleep(generate_sleep_time())
+            # delay for a random duration
+            time.sleep(generate_sleep_time())
 
-                # Random 0.1% chance to skip insertion (simulating an internal error)
-                if random.random() < 0.001:
-                    system_error_counter += 1
+            # Random 0.1% chance to skip insertion (simulating an internal error)
+            if random.random() < 0.001:
+                system_error_counter += 1
+                continue
+
+            if BULK_INSERT:
+                # An id that appears twice within the same message is a duplicate as well
+                if item[0] in pending_ids:
+                    received_duplicate_data_counter += 1
                     continue
 
+                # Collect the record, it gets inserted together with the rest of the message
+                pending_ids.add(item[0])
+                pending_data.append(item)
+                continue
+
+            try:
                 # Insert the record into database
                 cursor.execute("INSERT INTO Payments (id, amount, iban, payment_date) VALUES (%s, %s, %s, %s)", (item[0], item[1], item[2], item[3]))
                 conn.commit()
@@ -111,6 +139,19 @@ def insert_into_db(conn, data):
                 received_duplicate_data_counter += 1
                 conn.rollback()
 
+        if pending_data:
+            # Insert all collected records at once and commit them in a single transaction
+            inserted_ids = bulk_insert_payments(cursor, pending_data)
+            conn.commit()
+
+            for item in pending_data:
+                if item[0] in inserted_ids:
+                    # Add the record to the list of successfully inserted records
+                    successfully_inserted_data.append(item)
+                else:
+                    # Duplicate entry / idempotency
+                    received_duplicate_data_counter += 1
+
 
     else:
         # Validate the data item
@@ -163,45 +204,45 @@ def insert_into_db(conn, data):
 # ------------- Message Queue functions ------------- #
 
 def on_receive_message(ch, method, properties, body):
-    data = json.loads(body)
+    # Decode the message based on its content type
+    data = decode_message(body, properties)
 
     print(f"\nReceived message with {len(data)} rows.")
 
-    # Connect to the DB
-    conn = connect_to_db(host='192.168.0.24', dbname='db', user='postgres', password='postgres')
-
-    # Insert data into DB
-    successfully_inserted_data, invalid_iban_data = insert_into_db(conn, data)
+    # Check out a connection from the pool, it is returned automatically when done
+    with db_pool.connection() as conn:
+        # Insert data into DB
+        successfully_inserted_data, invalid_iban_data = insert_into_db(conn, data)
 
     # add a hint to which type of data is being sent
     successfully_inserted_data = { "type": "successful_insertion", "data": successfully_inserted_data }
     invalid_iban_data = { "type": "invalid_iban", "data": invalid_iban_data }
 
-    # Convert the successfully inserted data to a JSON string
-    successful_message = json.dumps(successfully_inserted_data)
-    invalid_message = json.dumps(invalid_iban_data)
+    # Encode the successfully inserted data and the invalid IBAN data
+    successful_message, successful_properties = encode_message(successfully_inserted_data, PAYMENTS_SCHEMA)
+    invalid_message, invalid_properties = encode_message(invalid_iban_data, PAYMENTS_SCHEMA)
 
     # Send the message to the queue
-    ch.basic_publish(exchange='', routing_key='validation', body=successful_message)
+    ch.basic_publish(exchange='', routing_key='validation', body=successful_message, properties=successful_properties)
     print(f"Message containing the successfully inserted data sent to the validation queue.")
 
     # Send the message to the queue
-    ch.basic_publish(exchange='', routing_key='validation', body=invalid_message)
+    ch.basic_publish(exchange='', routing_key='validation', body=invalid_message, properties=invalid_properties)
     print(f"Message containing the invalid IBAN data sent to the validation queue.")
 
     # Acknowledge message so it can be removed from the queue
     ch.basic_ack(delivery_tag=method.delivery_tag)
     print(f"Message acknowledged: {method.delivery_tag}")
 
-    # Close the database connection when done
-    if conn:
-        conn.close()
-
 
 
 # ------------- Main function ------------- #
 
 def main():
+    # Bring the schema of the ZD database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_1_ZD)
+
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
 
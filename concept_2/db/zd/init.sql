@@ -7,7 +7,7 @@ CREATE TABLE Payments (
 
 CREATE TABLE Log (
     id SERIAL PRIMARY KEY,
-    payment_id INTEGER,
+    payment_id INTEGER UNIQUE,
     validated BOOLEAN,
     inserted TIMESTAMP,
     iban TEXT NOT NULL,
@@ -16,7 +16,7 @@ CREATE TABLE Log (
 
 CREATE TABLE InvalidLog (
     id SERIAL PRIMARY KEY,
-    payment_id INTEGER,
+    payment_id INTEGER UNIQUE,
     validated BOOLEAN,
     inserted TIMESTAMP,
     iban TEXT NOT NULL
@@ -1,113 +1,155 @@
 """
 This script is run inside the EPLF-republish container.
 
-It retrieves all the unvalidated rows from the 'Log' table of the EPLF database,
-filters out the rows that have been inserted less than 20 minutes ago,
-as well as the ones that are faulty (previously found to have invalid IBANs).
-
-It then publishes the filtered data to the RabbitMQ 'data' queue to be consumed by the ZD once more.
-
-It runs in a loop with a 10 minute delay between each iteration.
+It retrieves the unvalidated rows from the 'Log' table of the EPLF database that are due to be resent:
+rows whose 'next_retry_at' has passed.
+
+It then publishes these rows to the RabbitMQ 'data' queue to be consumed by the ZD once more.
+The due rows are selected by the query using an index. Every resent row counts an attempt and is scheduled
+for its next resend with an exponential backoff (with jitter), so a ZD outage doesn't lead to the same rows being
+resent every iteration. Rows that reach MAX_ATTEMPTS are parked instead: they are no longer resent
+and are reported separately, as they need to be looked at manually (reset 'parked_at' and 'attempts' to retry them).
+The payments of the due rows are looked up in the same query and streamed from the database
+with a server-side cursor. Every chunk is published as its own message, so memory use doesn't grow with the backlog.
+Rows that are still leased ('leased_until', set by the publish service and by this service) are skipped, as they are
+most likely still waiting in the 'data' queue or being processed by the ZD. Every iteration reports how many due rows
+are leased at that moment (a gauge, the same rows are counted again as long as their lease lasts).
+A FlowController (see flow_control.py) limits the number of resent rows to what the consumers of the queue can take,
+so the resends don't swamp a lagging ZD. The remaining rows are resent in one of the next iterations.
+
+It runs in a loop with a 1 minute delay between each iteration.
 """
 
 
-import json
 import time
-import datetime
 import pika
-import psycopg2
+from database import ConnectionPool, stream_rows
+from migrations import apply_migrations, CONCEPT_2_EPLF
+from codec import encode_message, PAYMENTS_SCHEMA
+from flow_control import FlowController
+from queues import declare_data_queues
 
 
+# After its n-th resend, a row is resent again after RETRY_BASE_DELAY * 2^n seconds (at most RETRY_MAX_DELAY),
+# shortened by a random part of up to a half so the resends of a batch spread out.
+# The first resend happens 120 seconds after the row was inserted (see migrations.py).
+RETRY_BASE_DELAY = 120
+RETRY_MAX_DELAY = 3600
 
-# ------------- Database / data functions ------------- #
-
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
-        )
-        print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
-
-
-def get_data_from_log(conn):
-    # This function retrieves all the unvalidated rows from the 'Log' table
-    cursor = conn.cursor()
+# Rows that have been resent this many times without being validated are parked
+MAX_ATTEMPTS = 8
 
-    cursor.execute("""
-        SELECT *
-        FROM Log
-        WHERE validated = false
-    """)
+# Maximum number of rows per message of the publisher (see publish.py),
+# the FlowController starts its estimate of the rows per message in the queue with it
+CHUNK_SIZE = 500
 
-    return cursor.fetchall()
 
+# Pool of connections to the EPLF database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
 
-def filter_log_data(data) -> list:
-    # This function filters out the rows that have been inserted less than 20 minutes ago
-    filtered_data = []
 
-    for row in data:
-        payment_id = row[0]
-        iban = row[1]
-        validated = row[2]
-        inserted = row[3]
 
-        # calculate the time difference between now and the time the row was inserted
-        time_diff = (datetime.datetime.utcnow() - inserted).total_seconds()
+# ------------- Database / data functions ------------- #
 
-        # if the time difference is greater than 2 minutes, add the row to the filtered data
-        if time_diff > 120:
-            filtered_data.append((payment_id, iban, validated, inserted))
+def get_due_payments(conn, limit):
+    # This function streams (in chunks) up to 'limit' rows of the 'Payments' table whose unvalidated rows
+    # in the 'Log' table are due to be resent, so the backlog is never loaded into memory as a whole.
+    # The ids are collected by the subquery and looked up with the primary key index of 'Payments' in the same query,
+    # which is faster than a join (see benchmarks/payment_lookup_benchmark.py) and doesn't send any ids to the database.
+    # The condition on 'Log' matches the index 'log_retry_due_idx' (see migrations.py).
+    return stream_rows(conn, """
+        SELECT p.id, p.amount, p.iban, TO_CHAR(p.payment_date, 'YYYY-MM-DD') AS payment_date
+        FROM Payments p
+        WHERE p.id = ANY(ARRAY(
+            SELECT l.payment_id
+            FROM Log l
+            WHERE l.validated = false
+            AND l.parked_at IS NULL
+            AND l.next_retry_at <= (now() AT TIME ZONE 'UTC')
+            AND l.attempts < %s
+            AND (l.leased_until IS NULL OR l.leased_until <= (now() AT TIME ZONE 'UTC'))
+            LIMIT %s
+        ))
+    """, (MAX_ATTEMPTS, limit), name='due_payments')
+
+
+def schedule_next_retry(conn, payment_ids, lease_time):
+    # This function counts the attempt of the resent rows, schedules their next resend with an exponential backoff
+    # and leases them for 'lease_time' seconds, so they aren't resent while they are still queued.
+    # It is committed together with the rest of the iteration, once all chunks have been streamed.
+    # The expressions of the SET clause see the old 'attempts', so 'attempts + 1' is the number of the current resend.
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE Log
+        SET attempts = attempts + 1,
+            last_republished_at = now() AT TIME ZONE 'UTC',
+            next_retry_at = (now() AT TIME ZONE 'UTC')
+                + make_interval(secs => LEAST(%s * power(2, attempts + 1), %s) * (1 - random() / 2)),
+            leased_until = (now() AT TIME ZONE 'UTC') + make_interval(secs => %s)
+        WHERE payment_id = ANY(%s)
+    """, (RETRY_BASE_DELAY, RETRY_MAX_DELAY, lease_time, payment_ids))
+
+
+def park_exhausted_rows(conn):
+    # This function parks the due rows that have already been resent MAX_ATTEMPTS times.
+    # Returns the number of newly parked rows.
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE Log
+        SET parked_at = now() AT TIME ZONE 'UTC'
+        WHERE validated = false
+        AND parked_at IS NULL
+        AND next_retry_at <= (now() AT TIME ZONE 'UTC')
+        AND attempts >= %s
+    """, (MAX_ATTEMPTS,))
 
-    return filtered_data
+    return cursor.rowcount
 
 
-def get_data_from_payments(conn, log_data):
+def count_leased_rows(conn):
+    # This function returns the number of due rows that are currently skipped because they are still leased
     cursor = conn.cursor()
+    cursor.execute("""
+        SELECT count(*)
+        FROM Log
+        WHERE validated = false
+        AND parked_at IS NULL
+        AND next_retry_at <= (now() AT TIME ZONE 'UTC')
+        AND attempts < %s
+        AND leased_until > (now() AT TIME ZONE 'UTC')
+    """, (MAX_ATTEMPTS,))
+
+    return cursor.fetchone()[0]
+
 
-    # If log_data is empty, return an empty list
-    if not log_data:
-        return []
+def count_parked_rows(conn):
+    # This function returns the number of parked rows that are still unvalidated
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM Log WHERE validated = false AND parked_at IS NOT NULL")
 
+    return cursor.fetchone()[0]
 
-    if len(log_data) == 1:
-        # If there's only one row, doing the standard way will result in a syntax error within the SQL query
-        id = log_data[0][0]
 
-        cursor.execute(f"""
-                        SELECT id, amount, iban, TO_CHAR(payment_date,'YYYY-MM-DD') as payment_date
-                        FROM Payments
-                        WHERE id = {id}
-                    """)
 
-    else:
-        # Build the tuple of ids
-        ids = tuple(row[0] for row in log_data)
+# ------------- Message Queue functions ------------- #
 
+def resend_payments(channel, payments_data):
+    # Encode the rows and send them as a single message
+    message, properties = encode_message(payments_data, PAYMENTS_SCHEMA)
 
-        cursor.execute(f"""
-                        SELECT id, amount, iban, TO_CHAR(payment_date,'YYYY-MM-DD') as payment_date
-                        FROM Payments
-                        WHERE id IN {ids}
-                    """)
+    # Publish the message to the queue
+    channel.basic_publish(exchange='', routing_key='data', body=message, properties=properties)
 
-    return cursor.fetchall()
+    print(f"Resent {len(payments_data)} rows from the 'Payments' table.")
 
 
 
 # ------------- Main function ------------- #
 
 def main():
-    # Connect to database.
-    conn = connect_to_db(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
+    # Bring the schema of the EPLF database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_2_EPLF)
 
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
@@ -116,39 +158,53 @@ def main():
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='192.168.0.22', credentials=credentials, heartbeat=65535))
     channel = connection.channel()
 
-    # Declare the queue from which to receive messages
-    channel.queue_declare(queue='data')
+    # Declare the queue from which to receive messages, together with its dead letter and parking lot queues
+    declare_data_queues(channel)
+
+    # Limits the resends according to the backlog of the 'data' queue
+    flow_controller = FlowController(channel, 'data', rows_per_message=CHUNK_SIZE)
 
     sent_counter = 0
 
     while True:
-        # Retrieve data from the database
-        log_data = get_data_from_log(conn)
-
-        print(f"Retrieved {len(log_data)} rows from the 'Log' table.")
-
-        # Filter out the rows that have been inserted less than 20 minutes ago
-        filtered_data = filter_log_data(log_data)
-
-        print(f"Found {len(filtered_data)} rows that are old enough to be resent.")
-
-        # Retrieve up to 1000 rows from the 'Payments' table that correspond to the filtered data
-        payments_data = get_data_from_payments(conn, filtered_data)
-
-        print(f"Retrieved {len(payments_data)} rows from the 'Payments' table.")
-
-        # Only publish a message if rows to resend have been found
-        if len(payments_data) > 0:
-
-            # Convert all data to a JSON string and send as a single message
-            message = json.dumps(payments_data)
-
-            # Publish the message to the queue
-            channel.basic_publish(exchange='', routing_key='data', body=message)
-
-            # Increment the counter
-            sent_counter += len(payments_data)
-            print(f"Sent {sent_counter} rows in total \n")
+        # Only resend as many rows as the consumers can take right now
+        resend_budget = flow_controller.next_batch_size()
+        resent_rows = 0
+
+        if resend_budget == 0:
+            # Wait 1 minute before checking again
+            time.sleep(60)
+            continue
+
+        # Check out a connection from the pool, it is returned automatically when done
+        with db_pool.connection() as conn:
+            # Stop resending the rows that have reached the maximum number of attempts
+            parked_rows = park_exhausted_rows(conn)
+
+            # The resent rows are leased for as long as they are expected to stay in the queue
+            lease_time = flow_controller.lease_time(resend_budget)
+
+            # Stream the payments that are due to be resent (at most as many as the budget allows) chunk by chunk
+            for payments_data in get_due_payments(conn, resend_budget):
+                resend_payments(channel, payments_data)
+                flow_controller.record_published(len(payments_data), 1)
+                schedule_next_retry(conn, [row[0] for row in payments_data], lease_time)
+
+                # Increment the counter
+                resent_rows += len(payments_data)
+                sent_counter += len(payments_data)
+                print(f"Sent {sent_counter} rows in total \n")
+
+            # The named cursor is closed by now, so the schedules of the resent rows can be committed
+            conn.commit()
+
+            total_parked_rows = count_parked_rows(conn)
+            leased_rows = count_leased_rows(conn)
+
+        print(f"Resent {resent_rows} rows that were due in this iteration.")
+        print(f"{leased_rows} due rows are skipped as they are still in flight.")
+        print(f"Parked {parked_rows} rows after {MAX_ATTEMPTS} attempts, {total_parked_rows} parked rows are still unvalidated.")
+        print(f"Flow control: {flow_controller.metrics()}")
 
         # Wait 1 minute before sending the next message
         time.sleep(60)
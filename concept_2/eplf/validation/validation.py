@@ -8,120 +8,323 @@ The script will react the following way:
 
 No data:
     - triggers it to fetch and send the unvalidated rows in the 'Log' table of the EPLF DB back to the validator
+      (the rows are streamed from the database with a server-side cursor and sent in chunks of ITERSIZE rows,
+      the last chunk of a snapshot is marked in the message headers, every chunk carries the round id of the trigger)
+    - most rounds ask for a delta snapshot, which only contains the unvalidated rows that haven't been sent in a snapshot yet
+      (the validator keeps the unmatched rows between the rounds), a trigger without a 'snapshot' header asks for all unvalidated rows
+    - the sent rows are marked in the 'snapshot_sent' column in the same transaction, which is committed once the whole
+      snapshot has been published, so rows that are committed late or while the service restarts are sent with the next delta
+    - a digest round is answered with a single message holding one digest per range of DIGEST_RANGE_SIZE payment ids
+      instead of the rows (read from the 'LogDigest' table, which a trigger keeps up to date, see migrations.py)
+
+Ranges (with a 'message_type' header):
+    - 'validate_ranges': ranges whose digests are equal on both sides, all of their unvalidated rows are validated
+      without sending them (a range whose rows have changed since its digest was taken is skipped)
+    - 'range_request': ranges whose digests differ, their unvalidated rows are sent back like a snapshot
 
 Data:
     - contains the rows that were compared and validated by the validator service which are then updated in the 'Log' table of the EPLF DB
+
+The messages are consumed in micro-batches (see micro_batch.py): the updates of all messages of a batch are committed
+in one transaction and the messages are acknowledged together. Every trigger of a batch is answered for its own round,
+in the order they were received (a delta snapshot right after another one is usually empty).
 """
 
 
-import json
+import uuid
+import functools
 import pika
-import psycopg2
-import psycopg2.errors
+from database import ConnectionPool, stream_rows
+from migrations import apply_migrations, CONCEPT_2_EPLF, DIGEST_RANGE_SIZE
+from codec import encode_message, decode_message, LOG_SCHEMA, JSON_CONTENT_TYPE
+from micro_batch import MicroBatchConsumer
+
+
+
+# Pool of connections to the EPLF database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
 
 
 
 # ------------- Database / data functions ------------- #
 
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
+def get_last_log_id(conn):
+    # This function returns the id of the newest row of the 'Log' table
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(max(id), 0) FROM Log")
+
+    return cursor.fetchone()[0]
+
+
+def get_data_from_log(conn, unsent_only):
+    # This function streams the unvalidated rows from the 'Log' table in chunks, so the backlog is never loaded into memory
+    # as a whole. A delta snapshot only contains the rows that haven't been sent in a snapshot yet.
+    query = "SELECT payment_id, validated, iban FROM Log WHERE validated = false"
+
+    if unsent_only:
+        query += " AND snapshot_sent = false"
+
+    return stream_rows(conn, query, name='unvalidated_log_rows')
+
+
+def mark_as_sent(conn, chunks):
+    # This function passes the chunks on and marks their rows as sent in a snapshot.
+    # The marks only become visible when the transaction is committed after the whole snapshot has been published,
+    # so the rows are sent again if publishing fails.
+    cursor = conn.cursor()
+
+    for chunk in chunks:
+        cursor.execute(
+            """
+            UPDATE Log SET snapshot_sent = True
+            FROM unnest(%s::int[]) AS ids(payment_id)
+            WHERE Log.payment_id = ids.payment_id
+            """,
+            ([row[0] for row in chunk],)
         )
-        print(f"\nSuccessfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
+
+        yield chunk
+
+
+def get_data_from_ranges(conn, buckets):
+    # This function streams the unvalidated rows of the given ranges of payment ids from the 'Log' table in chunks
+    return stream_rows(conn, """
+        SELECT l.payment_id, l.validated, l.iban
+        FROM unnest(%(buckets)s::int[]) AS ranges(bucket)
+        JOIN Log l ON l.payment_id >= ranges.bucket * %(range_size)s AND l.payment_id < (ranges.bucket + 1) * %(range_size)s
+        WHERE l.validated = false
+    """, {'buckets': buckets, 'range_size': DIGEST_RANGE_SIZE}, name='range_log_rows')
 
 
-def get_data_from_log(conn):
-    # This function retrieves all the unvalidated rows from the 'Log' table
+def get_range_digests(conn):
+    # This function returns [bucket, row_count, digest] for every range with unvalidated rows,
+    # together with the id of the newest 'Log' row the digests cover.
+    # The changes the trigger appended to 'LogDigest' since the last call are summed up first, so the table stays small.
     cursor = conn.cursor()
+    cursor.execute("""
+        WITH removed AS (
+            DELETE FROM LogDigest RETURNING bucket, row_count, digest
+        )
+        INSERT INTO LogDigest (bucket, row_count, digest)
+        SELECT bucket, sum(row_count), bit_xor(digest)
+        FROM removed
+        GROUP BY bucket
+        HAVING sum(row_count) <> 0
+    """)
+    conn.commit()
 
+    # Read the digests and the newest row from the same snapshot of the database
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
     cursor.execute("""
-        SELECT payment_id, validated, iban
-        FROM Log
-        WHERE validated = false
+        SELECT bucket, sum(row_count)::bigint, bit_xor(digest)
+        FROM LogDigest
+        GROUP BY bucket
+        HAVING sum(row_count) <> 0
+        ORDER BY bucket
     """)
+    digests = [list(row) for row in cursor.fetchall()]
+    up_to_log_id = get_last_log_id(conn)
+    conn.commit()
 
-    return cursor.fetchall()
+    return digests, up_to_log_id
+
+
+def validate_ranges(conn, ranges, up_to_log_id):
+    # This function validates the unvalidated rows of the ranges whose digests are equal on both sides, all of them with a single statement.
+    # Only the rows the digests covered (up to the given 'Log' id) are validated, and only if they still have the compared digest,
+    # so a range that changed in the meantime is left for the next round.
+    # The changes are committed together with the rest of the batch.
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        WITH ranges AS (
+            SELECT * FROM unnest(%(buckets)s::int[], %(row_counts)s::bigint[], %(digests)s::bigint[]) AS ranges(bucket, row_count, digest)
+        ),
+        unchanged_ranges AS (
+            SELECT ranges.bucket
+            FROM ranges
+            JOIN Log l ON l.payment_id >= ranges.bucket * %(range_size)s AND l.payment_id < (ranges.bucket + 1) * %(range_size)s
+            WHERE l.validated = false
+            AND l.id <= %(up_to_log_id)s
+            GROUP BY ranges.bucket, ranges.row_count, ranges.digest
+            HAVING count(*) = ranges.row_count
+            AND bit_xor(log_row_hash(l.payment_id, l.iban)) = ranges.digest
+        )
+        UPDATE Log SET validated = True
+        FROM unchanged_ranges
+        WHERE Log.payment_id >= unchanged_ranges.bucket * %(range_size)s
+        AND Log.payment_id < (unchanged_ranges.bucket + 1) * %(range_size)s
+        AND Log.validated = false
+        AND Log.id <= %(up_to_log_id)s
+        """,
+        {
+            'buckets': [item[0] for item in ranges],
+            'row_counts': [item[1] for item in ranges],
+            'digests': [item[2] for item in ranges],
+            'range_size': DIGEST_RANGE_SIZE,
+            'up_to_log_id': up_to_log_id,
+        }
+    )
+
+    print(f"Validated {cursor.rowcount} records of {len(ranges)} equal ranges in the 'Log' table of the EPLF database. \n")
 
 
 
 def update_log(conn, data):
-    # update the corresponding rows in the 'Log' table of the EPLF database to be validated
+    # update the corresponding rows in the 'Log' table of the EPLF database to be validated, all of them with a single statement.
+    # The changes are committed together with the rest of the batch.
     cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE Log SET validated = True
+        FROM unnest(%s::int[]) AS ids(payment_id)
+        WHERE Log.payment_id = ids.payment_id
+        """,
+        ([row[0] for row in data],)
+    )
 
-    # Iterate over the data
-    for row in data:
-        # Get the payment_id from the row
-        payment_id = row[0]
+    print(f"Updated {cursor.rowcount} of {len(data)} records in the 'Log' table of the EPLF database to be validated. \n")
 
-        # Update the validated field in the 'Log' table where the payment_id matches
-        cursor.execute(
-            "UPDATE Log SET validated = True WHERE payment_id = %s",
-            (payment_id,)
-        )
 
-        conn.commit()
 
-    print(f"Updated {len(data)} records in the 'Log' table of the EPLF database to be validated. \n")
+# ------------- Message Queue functions ------------- #
 
+def send_log_data(ch, chunks, round_id):
+    # This function publishes every chunk of unvalidated rows as soon as it has been read from the database.
+    # One chunk is held back until the next one arrives, so the last chunk of the snapshot can be marked as such.
+    # An empty snapshot is sent as a single empty chunk, so the validator knows this side of the round is complete.
+    # Returns the number of sent rows.
+    snapshot_id = uuid.uuid4().hex
+    sequence_number = 0
+    sent_rows = 0
+    previous_chunk = None
+
+    for chunk in chunks:
+        if previous_chunk is not None:
+            publish_log_chunk(ch, previous_chunk, snapshot_id, round_id, sequence_number, last_chunk=False)
+            sequence_number += 1
+
+        sent_rows += len(chunk)
+        previous_chunk = chunk
+
+    publish_log_chunk(ch, previous_chunk or [], snapshot_id, round_id, sequence_number, last_chunk=True)
+
+    return sent_rows
+
+
+def publish_log_chunk(ch, chunk, snapshot_id, round_id, sequence_number, last_chunk):
+    # Encode the chunk and tag it with its snapshot, round and position, the validator waits for the last chunk
+    message, message_properties = encode_message(
+        chunk,
+        LOG_SCHEMA,
+        message_id=f"{snapshot_id}-{sequence_number}",
+        headers={
+            'batch_id': snapshot_id,
+            'round_id': round_id,
+            'sequence_number': sequence_number,
+            'last_chunk': last_chunk,
+        },
+    )
+
+    # Send the message to the queue
+    ch.basic_publish(exchange='', routing_key='eplf-to-validator', body=message, properties=message_properties)
+
+
+def send_digests(ch, digests, round_id, up_to_log_id):
+    # Encode the digests of all ranges as a single message, the validator compares them with the digests of the other side
+    message, message_properties = encode_message(
+        digests,
+        LOG_SCHEMA,
+        content_type=JSON_CONTENT_TYPE,
+        headers={
+            'round_id': round_id,
+            'message_type': 'digests',
+            'up_to_log_id': up_to_log_id,
+        },
+    )
+
+    # Send the message to the queue
+    ch.basic_publish(exchange='', routing_key='eplf-to-validator', body=message, properties=message_properties)
+
+
+def answer_trigger(ch, conn, round_id, snapshot):
+    # Sends the digests (digest round) or the unvalidated rows (full or delta snapshot) of the 'Log' table for the given round
+    if snapshot == 'digest':
+        print(f"Received empty message for round {round_id} (digest round). Reading the digests of the 'Log' table of the EPLF database.")
+
+        digests, up_to_log_id = get_range_digests(conn)
+        send_digests(ch, digests, round_id, up_to_log_id)
+
+        print(f"Digests of {len(digests)} ranges sent back to the validator service via the eplf-to-validator queue. \n")
+        return
+
+    print(f"Received empty message for round {round_id} ({snapshot} snapshot). Starting to retrieve data from the 'Log' table of the EPLF database.")
+
+    # stream the data from the 'Log' table and send it chunk by chunk, a delta snapshot only contains the rows
+    # that haven't been sent yet. The sent rows are marked once the whole snapshot has been published.
+    sent_rows = send_log_data(ch, mark_as_sent(conn, get_data_from_log(conn, snapshot != 'full')), round_id)
+    conn.commit()
+
+    if sent_rows > 0:
+        print(f"{sent_rows} unvalidated rows sent back to the validator service via the eplf-to-validator queue. \n")
 
+    else:
+        print(f"No unvalidated rows found in the 'Log' table of the EPLF database. \n")
 
-# ------------- Message Queue functions ------------- #
 
-def on_receive_message(ch, method, properties, body):
-    # Connect to the DB
-    conn = connect_to_db(host='192.168.0.23', dbname='db', user='postgres', password='postgres')
+def handle_batch(ch, batch):
+    # Applies the updates of all data messages of the batch in a single transaction and answers every trigger of the batch
+    # afterwards. The messages are acknowledged by the MicroBatchConsumer afterwards, or requeued if this raises.
 
-    data = None
+    # (round id, snapshot type) of the triggers, in the order they were received
+    triggers = []
 
-    try:
-        # Decode the JSON string back into a Python list
-        data = json.loads(body)
-    except json.JSONDecodeError:
-        print(f"Received empty message. Starting to retrieve data from the 'Log' table of the EPLF database.")
+    # Buckets of the requested ranges per round they have to be sent back with
+    range_requests = {}
 
-    # if there is data in the body, the message comes back from the listen.py script of the validator
-    # and is supposed to trigger the updating of the 'Log' table
-    if data and len(data) > 0:
-        update_log(conn, data)
+    # Check out a connection from the pool, it is returned automatically (and rolled back if this raises) when done
+    with db_pool.connection() as conn:
+        for method, properties, body in batch:
+            # Decode the message back into a Python list based on its content type, empty messages are decoded as None
+            data = decode_message(body, properties)
+            headers = properties.headers or {}
+            message_type = headers.get('message_type')
 
-    else:
-        # retrieve the data from the 'Log' table
-        log_data = get_data_from_log(conn)
+            if message_type == 'validate_ranges':
+                validate_ranges(conn, data, headers['up_to_log_id'])
+
+            elif message_type == 'range_request':
+                range_requests.setdefault(headers.get('round_id'), set()).update(data)
 
-        if len(log_data) > 0:
+            # if there is data in the body, the message comes back from the listen.py script of the validator
+            # and is supposed to trigger the updating of the 'Log' table
+            elif data and len(data) > 0:
+                update_log(conn, data)
 
-            # Convert the successfully inserted data to a JSON string
-            message = json.dumps(log_data)
+            else:
+                triggers.append((headers.get('round_id'), headers.get('snapshot', 'full')))
 
-            # Send the message to the queue
-            ch.basic_publish(exchange='', routing_key='eplf-to-validator', body=message)
-            print(f"{len(log_data)} unvalidated rows sent back to the validator service via the eplf-to-validator queue. \n")
+        # Commit the updates of the whole batch
+        conn.commit()
 
-        else:
-            print(f"No unvalidated rows found in the 'Log' table of the EPLF database. \n")
+        for range_round_id, buckets in range_requests.items():
+            # stream the rows of the requested ranges and send them chunk by chunk
+            sent_rows = send_log_data(ch, get_data_from_ranges(conn, sorted(buckets)), range_round_id)
 
-    # Acknowledge message so it can be removed from the queue
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(f"Message acknowledged: {method.delivery_tag}")
+            print(f"{sent_rows} unvalidated rows of {len(buckets)} differing ranges sent back to the validator service via the eplf-to-validator queue. \n")
 
-    # Close the database connection when done
-    if conn:
-        conn.close()
+        for round_id, snapshot in triggers:
+            answer_trigger(ch, conn, round_id, snapshot)
 
 
 
 # ------------- Main function ------------- #
 
 def main():
+    # Bring the schema of the EPLF database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_2_EPLF)
+
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
 
@@ -132,8 +335,8 @@ def main():
     # Declare the queue from which to receive messages
     channel.queue_declare(queue='validator-to-eplf')
 
-    # Declare the callback function
-    channel.basic_consume(queue='validator-to-eplf', on_message_callback=on_receive_message, auto_ack=False)
+    # Consume the messages in micro-batches
+    MicroBatchConsumer(connection, channel, 'validator-to-eplf', functools.partial(handle_batch, channel))
 
     print('Waiting for messages. To exit press CTRL+C')
 
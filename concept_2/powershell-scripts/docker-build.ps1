@@ -22,6 +22,7 @@ docker build --no-cache --rm -f "..\db\zd\Dockerfile" -t zd-db:latest "..\..\"
 # build the zd service image
 docker build --no-cache --rm -f "..\zd\listen\Dockerfile" -t zd-listen:latest "..\..\"
 docker build --no-cache --rm -f "..\zd\validation\Dockerfile" -t zd-validation:latest "..\..\"
+docker build --no-cache --rm -f "..\zd\dead_letter\Dockerfile" -t zd-dead-letter:latest "..\..\"
 
 
 
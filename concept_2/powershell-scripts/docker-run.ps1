@@ -62,6 +62,7 @@ docker run --network=containernetwork --name zd-listen2 -d -p 3007:3000 zd-liste
 docker run --network=containernetwork --name zd-listen3 -d -p 3008:3000 zd-listen:latest
 
 docker run --network=containernetwork --name zd-validation -d -p 3009:3000 zd-validation:latest
+docker run --network=containernetwork --name zd-dead-letter -d -p 3012:3000 zd-dead-letter:latest
 
 
 
@@ -31,6 +31,9 @@ docker rm zd-listen3
 docker stop zd-validation
 docker rm zd-validation
 
+docker stop zd-dead-letter
+docker rm zd-dead-letter
+
 
 docker stop zd-db
 docker rm zd-db
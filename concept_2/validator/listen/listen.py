@@ -3,170 +3,290 @@ This script is run inside the validator-listen container.
 
 It listens for messages from both the EPLF and ZD via the message queue,
 which contain the unvalidated data from their respective 'Log' tables.
+The unvalidated rows arrive in chunks, every snapshot belongs to the round whose trigger it answers
+(the 'round_id' header, see validator/publish.py). Most rounds only ask for the rows that were added since the previous one.
 
-These records then get compared and the matches get sent back to the EPLF and ZD via the message queue,
+The unmatched rows of both sides are kept between the rounds in a ReconciliationStore (see reconciliation.py),
+which indexes them by their 'payment_id'. Both queues are consumed with push consumers and the rows of every chunk
+are merged into the store as soon as it arrives: a row the other side already holds identically is a match,
+every other row is kept until the other side sends the same row or it expires. The work per round is therefore
+proportional to the rows sent in that round, not to the whole backlog.
+
+The matches get sent back to the EPLF and ZD via the message queue right away,
 so they can update the 'validated' field in their 'Log' tables accordingly.
+Rows that differ between both sides are reported.
+
+A round is finished once the snapshots of both sides are complete, which is when the expired rows are dropped
+and reported as missing in the ZD, missing in the EPLF or as field mismatches.
+The rows of chunks of finished or discarded rounds and of chunks that were received before (late or duplicate
+snapshots) are still merged into the store, as the services have already marked them as sent. Only the bookkeeping
+of their round is skipped.
+
+In a digest round both sides only send one digest per range of payment ids (see migrations.py).
+Once the digests of both sides are in, they are compared (see reconciliation.py):
+    - the ranges with equal digests are sent back to both sides ('validate_ranges'), which validate their rows
+      without the rows ever being sent
+    - the rows of the ranges whose digests differ are requested from both sides ('range_request'),
+      they arrive as snapshots of the round '<round id>-ranges' and are merged into the store like any other snapshot
 """
 
 
-import json
 import time
-from datetime import datetime
+import functools
+from collections import OrderedDict
 import pika
+from codec import encode_message, decode_message, LOG_SCHEMA, JSON_CONTENT_TYPE
+from reconciliation import ReconciliationStore, compare_digests, format_expired, EPLF, ZD
 
 
-# Global variables to store incoming data
-eplf_data = []
-zd_data = []
-successful_matches = []
+# Rounds that aren't complete after this many seconds are discarded (e.g. because one side never answered)
+ROUND_TIMEOUT = 600
 
+# Number of finished round ids that are remembered to recognise late or duplicate snapshots
+FINISHED_ROUNDS = 1000
 
 
-# ------------- Message Queue receive functions ------------- #
+# Unmatched rows of both sides
+store = ReconciliationStore()
 
-def on_receive_eplf_message(ch, method, properties, body):
-    # whenever a message is received on the validator-to-eplf queue, store it in the eplf_data list
-    global eplf_data
-    data = None
+# Rounds whose snapshots are still arriving, in the order of their first chunk:
+# round id -> {'started_at': ..., EPLF: snapshot, ZD: snapshot, 'digests': {side: (digests, up_to_log_id)}}
+# A snapshot remembers the sequence numbers of its received chunks and the number of its chunks.
+rounds = OrderedDict()
 
-    try:
-        # Decode the JSON string back into a Python list
-        data = json.loads(body)
-    except json.JSONDecodeError:
-        print(f"Received empty message from the EPLF. \n")
+# Ids of the rounds that have been finished or discarded
+finished_rounds = OrderedDict()
 
-    if data:
-        eplf_data = data
 
-        print(f"Received {len(data)} rows from the EPLF. \n")
 
+# ------------- Round functions ------------- #
 
-def on_receive_zd_message(ch, method, properties, body):
-    # whenever a message is received on the validator-to-zd queue, store it in the zd_data list
-    global zd_data
-    data = None
+def new_snapshot():
+    return {'sequence_numbers': set(), 'chunk_count': None}
 
-    try:
-        # Decode the JSON string back into a Python list
-        data = json.loads(body)
-    except json.JSONDecodeError:
-        print(f"Received empty message from the ZD. \n")
 
-    if data:
-        zd_data = data
+def start_round(round_id):
+    # Returns the state of the round, it is created when the first message of the round arrives
+    if round_id not in rounds:
+        rounds[round_id] = {'started_at': time.monotonic(), EPLF: new_snapshot(), ZD: new_snapshot(), 'digests': {}}
+
+    return rounds[round_id]
+
+
+def add_chunk(side, properties):
+    # Records a chunk in the snapshot of its round and side.
+    # Returns the round id, or None if the chunk belongs to a finished round or was received before
+    # and doesn't count towards the completion of its round.
+    headers = properties.headers if properties and properties.headers else {}
+    round_id = headers.get('round_id')
+
+    if round_id in finished_rounds:
+        print(f"Received a late or duplicate chunk of the finished round {round_id} from the {side.upper()}. \n")
+        return None
+
+    snapshot = start_round(round_id)[side]
+
+    # Messages without headers contain a whole snapshot
+    sequence_number = headers.get('sequence_number', 0)
+
+    if sequence_number in snapshot['sequence_numbers']:
+        print(f"Received a duplicate chunk of round {round_id} from the {side.upper()}. \n")
+        return None
+
+    snapshot['sequence_numbers'].add(sequence_number)
+
+    if headers.get('last_chunk', True):
+        snapshot['chunk_count'] = sequence_number + 1
+
+    return round_id
+
+
+def add_digests(side, properties, digests):
+    # Records the digests of one side of a digest round.
+    # Returns the round id, or None if the digests belong to a finished round and are ignored.
+    headers = properties.headers if properties and properties.headers else {}
+    round_id = headers.get('round_id')
+
+    if round_id in finished_rounds:
+        print(f"Ignoring late or duplicate digests of the finished round {round_id} from the {side.upper()}. \n")
+        return None
+
+    start_round(round_id)['digests'][side] = (digests, headers.get('up_to_log_id'))
+
+    return round_id
+
+
+def is_complete(snapshot):
+    # Returns True once every chunk of the snapshot has been received, in whatever order they arrived
+    return snapshot['chunk_count'] is not None and len(snapshot['sequence_numbers']) >= snapshot['chunk_count']
+
+
+def finish_round(round_id):
+    # Forgets the round and remembers its id, so later chunks of it are ignored
+    rounds.pop(round_id, None)
+    finished_rounds[round_id] = True
+
+    while len(finished_rounds) > FINISHED_ROUNDS:
+        finished_rounds.popitem(last=False)
+
+
+def expire_rounds():
+    # Discards the rounds that have been waiting for one side for too long
+    now = time.monotonic()
+
+    for round_id in [round_id for round_id, state in rounds.items() if now - state['started_at'] > ROUND_TIMEOUT]:
+        print(f"Discarding round {round_id}, its snapshots were not complete after {ROUND_TIMEOUT} seconds. \n")
+        finish_round(round_id)
+
+
+
+# ------------- Comparison functions ------------- #
+
+def compare_data(channel, side, data):
+    # Merges the rows into the store and sends the rows both sides now hold identically back to both services
+    matches, mismatches = store.add(side, data)
 
-        print(f"Received {len(data)} rows from the ZD. \n")
+    for eplf_row, zd_row in mismatches:
+        print(f"Rows of payment {eplf_row[0]} differ: EPLF {eplf_row}, ZD {zd_row}")
 
+    # If there were successful matches, send them back to both services to have them update their 'Log' tables
+    if matches:
+        send_eplf_matches(channel, matches)
+        send_zd_matches(channel, matches)
 
-def compare_data():
-    global eplf_data
-    global zd_data
-    global successful_matches
 
-    # Iterate through both data lists
-    for eplf_row in eplf_data:
-        for zd_row in zd_data:
+def compare_round_digests(channel, round_id):
+    # Compares the digests of both sides, lets both sides validate the equal ranges and requests the rows of the differing ones
+    digests = rounds[round_id]['digests']
+    equal_ranges, differing_buckets = compare_digests(digests[EPLF][0], digests[ZD][0])
 
-            # If the rows match, store them in the successful_matches list
-            if eplf_row == zd_row:
-                successful_matches.append(eplf_row)
+    # Each side only validates the rows its own digests covered
+    if equal_ranges:
+        send_ranges(channel, 'validator-to-eplf', 'validate_ranges', equal_ranges, {'up_to_log_id': digests[EPLF][1]})
+        send_ranges(channel, 'validator-to-zd', 'validate_ranges', equal_ranges, {'up_to_log_id': digests[ZD][1]})
 
-    # Reset the data lists for the next round of messages
-    eplf_data = []
-    zd_data = []
+    # The rows of the differing ranges are answered as snapshots of their own round
+    if differing_buckets:
+        send_ranges(channel, 'validator-to-eplf', 'range_request', differing_buckets, {'round_id': f"{round_id}-ranges"})
+        send_ranges(channel, 'validator-to-zd', 'range_request', differing_buckets, {'round_id': f"{round_id}-ranges"})
+
+    finish_round(round_id)
+
+    print(f"Digest round {round_id} is complete: {len(equal_ranges)} equal ranges, {len(differing_buckets)} differing ranges. \n")
+
+
+
+# ------------- Message Queue receive functions ------------- #
+
+def on_receive_message(ch, method, properties, body, side):
+    # whenever a chunk is received on the eplf-to-validator or zd-to-validator queue, merge its rows into the store
+    # Decode the message back into a Python list based on its content type, empty messages are decoded as None
+    data = decode_message(body, properties)
+    headers = properties.headers if properties and properties.headers else {}
+
+    # The digests of a digest round are compared once both sides have sent theirs
+    if headers.get('message_type') == 'digests':
+        print(f"Received the digests of {len(data)} ranges from the {side.upper()}. \n")
+
+        expire_rounds()
+        round_id = add_digests(side, properties, data)
+
+        if round_id in rounds and all(other_side in rounds[round_id]['digests'] for other_side in (EPLF, ZD)):
+            compare_round_digests(ch, round_id)
+
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    if data is None:
+        print(f"Received empty message from the {side.upper()}. \n")
+    else:
+        print(f"Received {len(data)} rows from the {side.upper()}. \n")
+
+    expire_rounds()
+    round_id = add_chunk(side, properties)
+
+    # The rows are merged even if the chunk is late or a duplicate, the services have already marked them as sent
+    # and merging a row again only refreshes it in the store
+    if data:
+        compare_data(ch, side, data)
+
+    # The round is finished as soon as the snapshots of both sides are complete
+    if round_id in rounds and all(is_complete(rounds[round_id][other_side]) for other_side in (EPLF, ZD)):
+        finish_round(round_id)
+        expired = store.expire()
+
+        print(f"Round {round_id} is complete, dropped expired rows: {format_expired(expired)}. \n")
+        print(f"{store.format_summary()}. \n")
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 
 # ------------- Message Queue publish functions ------------- #
 
 def send_eplf_matches(channel, matches):
-    # Convert the matches to JSON format
-    matches_json = json.dumps(matches)
+    # Encode the matches
+    message, properties = encode_message(matches, LOG_SCHEMA)
 
     # Publish the matches to the EPLF queue
-    channel.basic_publish(exchange='', routing_key='validator-to-eplf', body=matches_json)
+    channel.basic_publish(exchange='', routing_key='validator-to-eplf', body=message, properties=properties)
 
     print(f"Sent {len(matches)} rows to be validated back to the EPLF via the validator-to-eplf queue. \n")
 
 
 def send_zd_matches(channel, matches):
-    # Convert the matches to JSON format
-    matches_json = json.dumps(matches)
+    # Encode the matches
+    message, properties = encode_message(matches, LOG_SCHEMA)
 
     # Publish the matches to the ZD queue
-    channel.basic_publish(exchange='', routing_key='validator-to-zd', body=matches_json)
+    channel.basic_publish(exchange='', routing_key='validator-to-zd', body=message, properties=properties)
 
     print(f"Sent {len(matches)} rows to be validated back to the ZD via the validator-to-zd queue. \n")
 
 
+def send_ranges(channel, queue, message_type, ranges, headers):
+    # Encode the ranges and tag them with what the service is supposed to do with them
+    message, properties = encode_message(ranges, LOG_SCHEMA, content_type=JSON_CONTENT_TYPE, headers={'message_type': message_type, **headers})
+
+    # Publish the ranges to the queue of the service
+    channel.basic_publish(exchange='', routing_key=queue, body=message, properties=properties)
+
+    print(f"Sent {len(ranges)} ranges ({message_type}) via the {queue} queue. \n")
+
+
 
 # ------------- Main function ------------- #
 
 def main():
-    # Tell python to use the global variables
-    global eplf_data, zd_data, successful_matches
-
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
 
     # Creating the connection to RabbitMQ
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='192.168.0.22', credentials=credentials, heartbeat=65535))
 
-    # Create the EPLF channel and queue
-    validator_to_eplf_channel = connection.channel()
-    validator_to_eplf_channel.queue_declare(queue='validator-to-eplf')
-
-    # Create the EPLF to validator channel and queue
-    eplf_to_validator_channel = connection.channel()
-    eplf_to_validator_channel.queue_declare(queue='eplf-to-validator')
-
-    # Create the ZD validation channel and queue
-    validator_to_zd_channel = connection.channel()
-    validator_to_zd_channel.queue_declare(queue='validator-to-zd')
+    # Both queues are consumed on the same channel, so their callbacks never run at the same time
+    channel = connection.channel()
 
-    # Create the ZD to validator channel and queue
-    zd_to_validator_channel = connection.channel()
-    zd_to_validator_channel.queue_declare(queue='zd-to-validator')
+    # Declare the queues to the EPLF and ZD and the queues from the EPLF and ZD
+    channel.queue_declare(queue='validator-to-eplf')
+    channel.queue_declare(queue='eplf-to-validator')
+    channel.queue_declare(queue='validator-to-zd')
+    channel.queue_declare(queue='zd-to-validator')
 
-    # Todo: fix
+    # Declare the callback functions
+    channel.basic_consume(queue='eplf-to-validator', on_message_callback=functools.partial(on_receive_message, side=EPLF), auto_ack=False)
+    channel.basic_consume(queue='zd-to-validator', on_message_callback=functools.partial(on_receive_message, side=ZD), auto_ack=False)
 
     print('Waiting for messages. To exit press CTRL+C')
 
     try:
-        # Create an infinite loop
-        while True:
-
-            # Consume one message at a time from each channel
-            eplf_method, eplf_properties, eplf_body = eplf_to_validator_channel.basic_get(queue='eplf-to-validator', auto_ack=True)
-            zd_method, zd_properties, zd_body = zd_to_validator_channel.basic_get(queue='zd-to-validator', auto_ack=True)
-
-            # If a message was received, process it
-            if eplf_method:
-                on_receive_eplf_message(eplf_to_validator_channel, eplf_method, eplf_properties, eplf_body)
-
-            if zd_method:
-                on_receive_zd_message(zd_to_validator_channel, zd_method, zd_properties, zd_body)
-
-            # Check if both lists have data
-            if eplf_data and zd_data:
-                compare_data()
-
-                # If there were successful matches, send them back to both services to have them update their 'Log' tables
-                if successful_matches:
-                    send_eplf_matches(validator_to_eplf_channel, successful_matches)
-                    send_zd_matches(validator_to_zd_channel, successful_matches)
-
-                    # Reset the successful_matches list for the next round of messages
-                    successful_matches = []
-
-            # Messages from the EPLF and ZD should come in about every minute at roughly the same time
-            # so checking for new messages every 30 seconds should be sufficient
-            time.sleep(30)
-
+        # Start the consumer in an infinite loop
+        channel.start_consuming()
     except KeyboardInterrupt:
-        # CTRL+C closes the connection
+        # CTRL+C breaks the infinite loop and closes the connection
+        channel.stop_consuming()
         connection.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -4,13 +4,26 @@ This script is run inside the validator-publish container.
 It periodically sends a message to both (the EPLF and ZD) via the message queue,
 which triggers them to send the unvalidated rows in their 'Log' tables back to the validator,
 which listens for said messages via its own listen.py script.
+
+Every trigger carries a new round id in its headers, which the EPLF and ZD attach to their snapshots,
+so the validator only compares snapshots that were sent for the same round.
+Most rounds only ask for the rows that were added since the previous snapshot ('snapshot': 'delta').
+Every DIGEST_ROUND_INTERVAL-th round is a digest round ('snapshot': 'digest'): both sides only send one digest
+per range of payment ids, and only the rows of the ranges whose digests differ are requested afterwards
+(see validator/listen.py).
 """
 
 
 import time
+import uuid
 import pika
 
 
+# Every n-th round (starting with the first one) is a digest round. The time between two digest rounds
+# has to be shorter than the STORE_TTL of the validator (see reconciliation.py), so unmatched rows are refreshed before they expire.
+DIGEST_ROUND_INTERVAL = 10
+
+
 
 # ------------- Main function ------------- #
 
@@ -35,16 +48,21 @@ def main():
         # No message content needed. The message itself is the trigger.
         message = ""
 
+        # Both services answer the trigger with a snapshot of the same round
+        round_id = uuid.uuid4().hex
+        snapshot = 'digest' if sent_counter % DIGEST_ROUND_INTERVAL == 0 else 'delta'
+        properties = pika.BasicProperties(message_id=round_id, headers={'round_id': round_id, 'snapshot': snapshot})
+
         # Publish the message to the validator-to-eplf queue.
-        eplf_channel.basic_publish(exchange='', routing_key='validator-to-eplf', body=message)
+        eplf_channel.basic_publish(exchange='', routing_key='validator-to-eplf', body=message, properties=properties)
 
         # Publish the message to the validator-to-zd queue.
-        zd_channel.basic_publish(exchange='', routing_key='validator-to-zd', body=message)
+        zd_channel.basic_publish(exchange='', routing_key='validator-to-zd', body=message, properties=properties)
 
         # Increment the counter.
         sent_counter += 1
 
-        print(f"Sent message to both EPLF and ZD.")
+        print(f"Sent message for round {round_id} ({snapshot} snapshot) to both EPLF and ZD.")
         print(f"This is iteration number: {sent_counter}.\n")
 
         # Wait 1 minutes before sending the next message.
@@ -0,0 +1,160 @@
+"""
+This script drains the 'data-dead-letter' and 'data-parking-lot' queues (see queues.py) at a low pace,
+so the payloads the ZD listener could not process don't compete with the 'data' queue.
+
+Messages in the 'data-dead-letter' queue were either rejected by the ZD listener or contain rows that hit the simulated system error.
+They are put back into the 'data' queue until they have failed MAX_DEATHS times, after which they are moved to the 'data-parking-lot' queue.
+
+Messages in the 'data-parking-lot' queue will never succeed:
+    - rows with invalid IBANs are inserted into the 'InvalidLog' table of the ZD database, so the validation service can report them
+    - malformed rows and messages that failed MAX_DEATHS times are printed and dropped
+      (rows that never reached the 'Log' table of the ZD stay unvalidated in the EPLF and are resent by its republish service)
+
+If the rows with invalid IBANs can't be inserted, the message is put back into the 'data-parking-lot' queue after RETRY_DELAY seconds.
+"""
+
+
+import time
+import pika
+from psycopg2.extras import execute_values
+from database import ConnectionPool
+from codec import decode_message
+from queues import (declare_data_queues, death_count, retry_headers,
+                    DATA_QUEUE, DEAD_LETTER_QUEUE, PARKING_LOT_QUEUE, MAX_DEATHS, REASON_HEADER)
+
+
+# Time (in seconds) to wait after each message, so this consumer only uses the capacity left over by the ZD listeners
+DRAIN_DELAY = 1
+
+# Time (in seconds) to wait before a parked message whose rows could not be inserted is put back into the queue
+RETRY_DELAY = 10
+
+
+# Pool of connections to the ZD database, reused across messages instead of connecting for each one
+db_pool = ConnectionPool(host='192.168.0.24', dbname='db', user='postgres', password='postgres', size=1)
+
+
+
+# ------------- Database / data functions ------------- #
+
+def insert_into_invalid_log(conn, rows):
+    # Inserts one row per payment into the 'InvalidLog' table, skipping payments that already have a row.
+    # Returns the number of newly inserted rows.
+    cursor = conn.cursor()
+
+    execute_values(
+        cursor,
+        """
+        INSERT INTO InvalidLog (payment_id, iban, validated, inserted) VALUES %s
+        ON CONFLICT (payment_id) DO NOTHING
+        """,
+        [(item[0], item[2]) for item in rows],
+        template="(%s, %s, False, now() AT TIME ZONE 'UTC')",
+        page_size=len(rows)
+    )
+    conn.commit()
+
+    return cursor.rowcount
+
+
+
+# ------------- Message Queue functions ------------- #
+
+def forward_message(channel, queue, body, properties, headers):
+    # Publishes the unchanged body to the given queue with new headers
+    channel.basic_publish(
+        exchange='',
+        routing_key=queue,
+        body=body,
+        properties=pika.BasicProperties(
+            content_type=properties.content_type,
+            content_encoding=properties.content_encoding,
+            message_id=properties.message_id,
+            headers=headers,
+        )
+    )
+
+
+def on_dead_letter(ch, method, properties, body):
+    # Puts the message back into the 'data' queue, or parks it if it failed too often already
+    deaths = death_count(properties)
+
+    if deaths < MAX_DEATHS:
+        forward_message(ch, DATA_QUEUE, body, properties, retry_headers(properties))
+        print(f"Retrying dead-lettered message (failed {deaths} times).")
+    else:
+        headers = retry_headers(properties)
+        headers[REASON_HEADER] = 'max_deaths'
+        forward_message(ch, PARKING_LOT_QUEUE, body, properties, headers)
+        print(f"Parked dead-lettered message after {deaths} failures.")
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    time.sleep(DRAIN_DELAY)
+
+
+def on_parked(ch, method, properties, body):
+    # Records the rows with invalid IBANs, the other parked payloads are only printed
+    headers = properties.headers or {}
+    reason = headers.get(REASON_HEADER, 'unknown')
+
+    try:
+        data = decode_message(body, properties)
+    except Exception as e:
+        data = None
+        print(f"Could not decode parked message: {e}")
+
+    if reason == 'invalid_iban' and data:
+        try:
+            with db_pool.connection() as conn:
+                inserted_rows = insert_into_invalid_log(conn, data)
+
+        except Exception as e:
+            # Keep the rows, the message is received again after the delay
+            print(f"Could not insert {len(data)} rows with invalid IBANs into the 'InvalidLog' table, requeueing the message: {e}")
+            time.sleep(RETRY_DELAY)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+
+        print(f"Successfully inserted {inserted_rows} rows with invalid IBANs into the 'InvalidLog' table of the ZD database.")
+    else:
+        row_count = len(data) if isinstance(data, list) else 0
+        print(f"Dropping parked message {properties.message_id} ({reason}) with {row_count} rows: {data}")
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    time.sleep(DRAIN_DELAY)
+
+
+
+# ------------- Main function ------------- #
+
+def main():
+    # Provide authentication for the mq
+    credentials = pika.PlainCredentials('rabbit', 'rabbit')
+
+    # Creating the connection to RabbitMQ
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host='192.168.0.22', credentials=credentials, heartbeat=65535))
+    channel = connection.channel()
+
+    # Declare the 'data' queue together with its dead letter and parking lot queues
+    declare_data_queues(channel)
+
+    # Take one message at a time
+    channel.basic_qos(prefetch_count=1)
+
+    channel.basic_consume(queue=DEAD_LETTER_QUEUE, on_message_callback=on_dead_letter, auto_ack=False)
+    channel.basic_consume(queue=PARKING_LOT_QUEUE, on_message_callback=on_parked, auto_ack=False)
+
+    # Print status
+    print('Draining the dead letter and parking lot queues. To exit press CTRL+C')
+
+    try:
+        # Start consumer in infinite loop.
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        # Handle shutdown signal.
+        channel.stop_consuming()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
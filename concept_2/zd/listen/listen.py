@@ -4,57 +4,95 @@ This script listens to the 'data' queue and processes the incoming messages cont
 The insertion has a random delay between 10ms and 100ms to simulate a real-world scenario.
 
 After validating the IBANs, it inserts the received data into the 'Payments' table of the ZD database.
+All rows of a message are written with a single set-based INSERT.
 
-Each row is also inserted into the either the 'Log' table or the `InvalidLog` table of the ZD database, based on the validity of its IBAN.
+Each inserted row is also inserted into the 'Log' table of the ZD database.
+The 'Log' table is written with one statement and committed in the same transaction as the 'Payments' rows.
 
 There is also a 0.01% chance that the insertion is skipped to simulate a system error.
 
-This will result in the row not being added to either of the 'Log' or 'InvalidLog' tables and it getting noticed later by the validation service. 
+Rows that can't be processed are not retried by this listener (see queues.py):
+    - rows with invalid IBANs and malformed rows will never succeed and are moved to the 'data-parking-lot' queue,
+      where the dead_letter.py consumer writes the rows with invalid IBANs into the 'InvalidLog' table
+    - rows that hit the simulated system error are moved to the 'data-dead-letter' queue to be retried later
+    - messages that fail as a whole are rejected, which makes RabbitMQ move them to the 'data-dead-letter' queue
+
+Errors that only mean the database can't be reached right now (e.g. while it restarts) are not counted as failures:
+the message is retried up to DB_ATTEMPTS times with an exponential backoff and then put back into the 'data' queue.
+
+Messages are processed in parallel by a pool of worker threads, each of them using its own database connection.
+The acknowledgements are handed back to the thread of the RabbitMQ connection, which keeps receiving messages and sending heartbeats meanwhile.
 """
 
 
-import json
 import time
 import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pika
 import psycopg2
 import psycopg2.errors
-from schwifty import IBAN
-from schwifty.exceptions import InvalidChecksumDigits
+from psycopg2.extras import execute_values
+from iban_validator import is_iban_valid, validate_ibans
+from database import ConnectionPool, backoff_delay, TRANSIENT_ERRORS
+from migrations import apply_migrations, CONCEPT_2_ZD
+from codec import encode_message, decode_message, PAYMENTS_SCHEMA, JSON_CONTENT_TYPE
+from queues import (declare_data_queues, death_count, failure_headers,
+                    DEAD_LETTER_EXCHANGE, DEAD_LETTER_QUEUE, PARKING_LOT_QUEUE, MAX_DEATHS, REASON_HEADER)
+
+
+# Write the rows of a message with one set-based INSERT and a single commit
+# instead of one INSERT and one commit per row
+BULK_INSERT = True
+
+# Number of messages that are processed in parallel (1 processes the messages one after another)
+WORKER_COUNT = 4
+
+# Maximum number of unacknowledged messages RabbitMQ delivers to this consumer at once
+PREFETCH_COUNT = 8
+
+# Number of times a message is processed while the database is unavailable before it is put back into the 'data' queue
+DB_ATTEMPTS = 5
+
+
+# Pool of connections to the ZD database, reused across messages instead of connecting for each one.
+# It holds one connection per worker thread.
+db_pool = ConnectionPool(host='192.168.0.24', dbname='db', user='postgres', password='postgres', size=WORKER_COUNT)
 
 
 
 # ------------- Database / data functions ------------- #
 
-def connect_to_db(host, dbname, user, password, port=5432):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=host,
-            database=dbname,
-            user=user,
-            password=password,
-            port=port,
-        )
-        print(f"Successfully connected to PostgreSQL database with id {id(conn)}")
-    except Exception as e:
-        print(f"Error occurred: {e}")
-    return conn
+def bulk_insert_payments(cursor, rows):
+    # Inserts all rows with a single statement and returns the set of ids that were actually inserted.
+    # Ids that already exist in the 'Payments' table are skipped by the database instead of raising a UniqueViolation,
+    # so they are simply missing from the returned set.
+    if not rows:
+        return set()
 
+    inserted_rows = execute_values(
+        cursor,
+        """
+        INSERT INTO Payments (id, amount, iban, payment_date) VALUES %s
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+        """,
+        [(row[0], row[1], row[2], row[3]) for row in rows],
+        page_size=len(rows),
+        fetch=True
+    )
 
-def is_iban_valid(iban):
-    # Returns True if the IBAN is valid, False otherwise
-    try:
-        iban = IBAN(iban)
-        return True
-    except InvalidChecksumDigits:
-        return False
+    return {row[0] for row in inserted_rows}
 
 
 def insert_into_payments(conn, data):
+    # Returns the successfully inserted rows, the rows with invalid IBANs, the malformed rows
+    # and the rows that hit the simulated system error
     successfully_inserted_data = []
     invalid_iban_data = []
+    invalid_data = []
+    system_error_data = []
     system_error_counter = 0
     received_invalid_data_counter = 0
     received_duplicate_data_counter = 0
@@ -75,29 +113,49 @@ def insert_into_payments(conn, data):
 
     # Check if data is list or single record
     if isinstance(data, list):
+        # Records that passed validation and still need to be written (only used when BULK_INSERT is set)
+        pending_data = []
+        pending_ids = set()
+
+        # Validate the IBANs of all records at once
+        iban_mask = validate_ibans(item[2] if len(item) >= 4 else None for item in data)
+
         # Loop through each record in list
-        for item in data:
+        for item, iban_is_valid in zip(data, iban_mask):
 
             # Validate the data item
             if len(item) < 4:
                 print(f"Received invalid data: {item}")
                 received_invalid_data_counter += 1
+                invalid_data.append(item)
                 continue
 
             # Validate the IBAN
-            if not is_iban_valid(item[2]):
+            if not iban_is_valid:
                 invalid_iban_data.append(item)
                 continue
 
-            try:
-                # delay for a random duration
-                time.sleep(generate_sleep_time())
+            # delay for a random duration
+            time.sleep(generate_sleep_time())
+
+            # Random 0.1% chance to skip insertion (simulating an internal error)
+            if random.random() < 0.001:
+                system_error_counter += 1
+                system_error_data.append(item)
+                continue
 
-                # Random 0.1% chance to skip insertion (simulating an internal error)
-                if random.random() < 0.001:
-                    system_error_counter += 1
+            if BULK_INSERT:
+                # An id that appears twice within the same message is a duplicate as well
+                if item[0] in pending_ids:
+                    received_duplicate_data_counter += 1
                     continue
 
+                # Collect the record, it gets inserted together with the rest of the message
+                pending_ids.add(item[0])
+                pending_data.append(item)
+                continue
+
+            try:
                 # Insert the record into database
                 cursor.execute("INSERT INTO Payments (id, amount, iban, payment_date) VALUES (%s, %s, %s, %s)", (item[0], item[1], item[2], item[3]))
                 conn.commit()
@@ -110,17 +168,30 @@ def insert_into_payments(conn, data):
                 received_duplicate_data_counter += 1
                 conn.rollback()
 
+        if pending_data:
+            # Insert all collected records at once, they are committed together with the 'Log' rows of the message
+            inserted_ids = bulk_insert_payments(cursor, pending_data)
+
+            for item in pending_data:
+                if item[0] in inserted_ids:
+                    # Add the record to the list of successfully inserted records
+                    successfully_inserted_data.append(item)
+                else:
+                    # Duplicate entry / idempotency
+                    received_duplicate_data_counter += 1
+
 
     else:
         # Validate the data item
         if len(data) < 4:
             received_invalid_data_counter += 1
-            return successfully_inserted_data, invalid_iban_data
+            invalid_data.append(data)
+            return successfully_inserted_data, invalid_iban_data, invalid_data, system_error_data
 
         # Validate the IBAN
         if not is_iban_valid(data[2]):
             invalid_iban_data.append(data)
-            return successfully_inserted_data, invalid_iban_data
+            return successfully_inserted_data, invalid_iban_data, invalid_data, system_error_data
 
         # Insert single record into database
         try:
@@ -130,7 +201,8 @@ def insert_into_payments(conn, data):
             # Random 0.1% chance to skip insertion (simulating an internal error)
             if random.random() < 0.001:
                 system_error_counter += 1
-                return successfully_inserted_data, invalid_iban_data
+                system_error_data.append(data)
+                return successfully_inserted_data, invalid_iban_data, invalid_data, system_error_data
 
             cursor.execute("INSERT INTO Payments (id, amount, iban, payment_date) VALUES (%s, %s, %s, %s)", (data[0], data[1], data[2], data[3]))
             conn.commit()
@@ -155,82 +227,170 @@ def insert_into_payments(conn, data):
         print(f"Invalid data: {received_invalid_data_counter}")
         print(f"Duplicate data: {received_duplicate_data_counter}")
 
-    return successfully_inserted_data, invalid_iban_data
+    return successfully_inserted_data, invalid_iban_data, invalid_data, system_error_data
 
 
-def insert_into_log_db(conn, successfully_inserted_data, invalid_iban_data):
-    # Create a database cursor
+def upsert_log_rows(cursor, table, rows):
+    # Inserts one row per payment into the given log table with a single statement.
+    # Payments that already have a row are skipped thanks to the unique constraint on 'payment_id'.
+    # Returns the number of newly inserted rows.
+    if not rows:
+        return 0
+
+    execute_values(
+        cursor,
+        f"""
+        INSERT INTO {table} (payment_id, iban, validated, inserted) VALUES %s
+        ON CONFLICT (payment_id) DO NOTHING
+        """,
+        [(item[0], item[2]) for item in rows],
+        template="(%s, %s, False, now() AT TIME ZONE 'UTC')",
+        page_size=len(rows)
+    )
+
+    return cursor.rowcount
+
+
+def insert_into_log_db(conn, successfully_inserted_data):
+    # Inserts the rows into the 'Log' table without committing,
+    # so they are committed in the same transaction as the rows of the 'Payments' table.
+    # The rows with invalid IBANs are written into the 'InvalidLog' table by the dead_letter.py consumer.
     cursor = conn.cursor()
 
     # Insert the successfully inserted data into the 'Log' table of the ZD database
-    for item in successfully_inserted_data:
+    inserted_rows = upsert_log_rows(cursor, 'Log', successfully_inserted_data)
 
-        cursor.execute(
-            """
-            INSERT INTO Log (payment_id, iban, validated, inserted)
-            SELECT %s, %s, False, now() AT TIME ZONE 'UTC'
-            WHERE NOT EXISTS (
-                SELECT 1 FROM Log WHERE payment_id = %s
-            )
-            """,
-            (item[0], item[2], item[0])
-        )
+    print(f"Successfully inserted {inserted_rows} valid rows into the 'Log' table of the ZD database.")
 
-        conn.commit()
 
-    print(f"Successfully inserted {len(successfully_inserted_data)} valid rows into the 'Log' table of the ZD database.")
+def store_message(data):
+    # Writes the rows of a message into the 'Payments' and 'Log' tables and commits them as one unit of work.
+    # While the database is unavailable, this is retried with an exponential backoff, the last error is raised after DB_ATTEMPTS attempts.
+    # Returns the rows sorted by their outcome, see insert_into_payments.
+    for attempt in range(DB_ATTEMPTS):
+        try:
+            # Check out a connection from the pool, it is returned automatically (or discarded if it broke) when done
+            with db_pool.connection() as conn:
+                # Insert data into payments DB
+                result = insert_into_payments(conn, data)
 
-    # Insert the invalid IBAN data into the 'Log' table of the ZD database
-    for item in invalid_iban_data:
+                # Insert successfully inserted data into the 'Log' table of the ZD database
+                if result[0]:
+                    insert_into_log_db(conn, result[0])
 
-        cursor.execute(
-            """
-            INSERT INTO InvalidLog (payment_id, iban, validated, inserted)
-            SELECT %s, %s, False, now() AT TIME ZONE 'UTC'
-            WHERE NOT EXISTS (
-                SELECT 1 FROM InvalidLog WHERE payment_id = %s
-            )
-            """,
-            (item[0], item[2], item[0])
-        )
+                # Commit the 'Payments' and 'Log' rows of the message as one unit of work
+                conn.commit()
 
-        conn.commit()
+            return result
 
+        except TRANSIENT_ERRORS as e:
+            if attempt == DB_ATTEMPTS - 1:
+                raise
 
-    print(f"Successfully inserted {len(invalid_iban_data)} rows with invalid IBANs into the 'InvalidLog' table of the ZD database.")
+            delay = backoff_delay(attempt)
+            print(f"The ZD database is unavailable ({e}), retrying in {delay} seconds.")
+            time.sleep(delay)
 
 
 
 # ------------- Message Queue functions ------------- #
 
-def on_receive_message(ch, method, properties, body):
-    data = json.loads(body)
+def process_message(connection, channel, delivery_tag, properties, body):
+    # This function runs inside one of the worker threads.
+    # pika channels are not thread-safe, so the acknowledgement is scheduled on the thread of the RabbitMQ connection.
+    try:
+        # Decode the message based on its content type
+        data = decode_message(body, properties)
+        headers = properties.headers or {}
+
+        print(f"\nReceived message with {len(data)} rows.")
+
+        # Messages published in chunks carry their batch and position within the batch
+        if 'batch_id' in headers:
+            print(f"Chunk {headers['sequence_number'] + 1} of {headers['chunk_count']} of batch {headers['batch_id']}.")
+
+        successfully_inserted_data, invalid_iban_data, invalid_data, system_error_data = store_message(data)
+
+    except TRANSIENT_ERRORS as e:
+        # The message itself is fine, put it back into the 'data' queue instead of counting it as a failure
+        print(f"The ZD database is still unavailable, requeueing message {delivery_tag}: {e}")
+        connection.add_callback_threadsafe(functools.partial(requeue_message, channel, delivery_tag))
+        return
+
+    except Exception as e:
+        # Let RabbitMQ move the message to the dead letter queue, instead of receiving it again right away
+        print(f"Error occurred while processing message {delivery_tag}: {e}")
+        connection.add_callback_threadsafe(functools.partial(reject_message, channel, delivery_tag))
+        return
+
+    # Collect the rows that have to be moved out of the way, as (exchange, queue, rows, headers)
+    failed_rows = []
+
+    if invalid_iban_data:
+        failed_rows.append(('', PARKING_LOT_QUEUE, invalid_iban_data, failure_headers(properties, 'invalid_iban')))
 
-    print(f"\nReceived message with {len(data)} rows.")
+    if invalid_data:
+        failed_rows.append(('', PARKING_LOT_QUEUE, invalid_data, failure_headers(properties, 'malformed')))
 
-    # Connect to the DB
-    conn = connect_to_db(host='192.168.0.24', dbname='db', user='postgres', password='postgres')
+    if system_error_data:
+        # Rows that failed as often as allowed are parked instead of being retried once more
+        if death_count(properties) + 1 >= MAX_DEATHS:
+            failed_rows.append(('', PARKING_LOT_QUEUE, system_error_data, failure_headers(properties, 'max_deaths')))
+        else:
+            failed_rows.append((DEAD_LETTER_EXCHANGE, DEAD_LETTER_QUEUE, system_error_data,
+                                failure_headers(properties, 'system_error')))
 
-    # Insert data into payments DB
-    successfully_inserted_data, invalid_iban_data = insert_into_payments(conn, data)
+    connection.add_callback_threadsafe(functools.partial(acknowledge_message, channel, delivery_tag, failed_rows))
 
-    # Insert successfully inserted data into the 'Log' table of the ZD database
-    if successfully_inserted_data or invalid_iban_data:
-        insert_into_log_db(conn, successfully_inserted_data, invalid_iban_data)
 
-    # Acknowledge message so it can be removed from the queue
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(f"Message acknowledged: {method.delivery_tag}")
+def publish_failed_rows(channel, exchange, queue, rows, headers):
+    # Malformed rows don't fit the columnar payments format, so all failed rows are sent as JSON
+    body, properties = encode_message(rows, PAYMENTS_SCHEMA, content_type=JSON_CONTENT_TYPE, headers=headers)
+    channel.basic_publish(exchange=exchange, routing_key=queue, body=body, properties=properties)
 
-    # Close the database connection when done
-    if conn:
-        conn.close()
+    print(f"Moved {len(rows)} rows to the '{queue}' queue ({headers[REASON_HEADER]}).")
+
+
+def acknowledge_message(channel, delivery_tag, failed_rows):
+    # Move the failed rows out of the way and acknowledge the message so it can be removed from the queue
+    # (runs on the thread of the RabbitMQ connection)
+    if channel.is_open:
+        for exchange, queue, rows, headers in failed_rows:
+            publish_failed_rows(channel, exchange, queue, rows, headers)
+
+        channel.basic_ack(delivery_tag=delivery_tag)
+        print(f"Message acknowledged: {delivery_tag}")
+
+
+def reject_message(channel, delivery_tag):
+    # Reject the message without requeueing it, so RabbitMQ moves it to the dead letter queue
+    # (runs on the thread of the RabbitMQ connection)
+    if channel.is_open:
+        channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        print(f"Message dead-lettered: {delivery_tag}")
+
+
+def requeue_message(channel, delivery_tag):
+    # Put the message back into the 'data' queue, so it is processed again once the database is back
+    # (runs on the thread of the RabbitMQ connection)
+    if channel.is_open:
+        channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        print(f"Message requeued: {delivery_tag}")
+
+
+def on_receive_message(ch, method, properties, body, connection, executor):
+    # Hand the message over to a worker thread, so this thread can keep receiving messages and sending heartbeats
+    executor.submit(process_message, connection, ch, method.delivery_tag, properties, body)
 
 
 
 # ------------- Main function ------------- #
 
 def main():
+    # Bring the schema of the ZD database up to date before doing anything else
+    with db_pool.connection() as conn:
+        apply_migrations(conn, CONCEPT_2_ZD)
+
     # Provide authentication for the mq
     credentials = pika.PlainCredentials('rabbit', 'rabbit')
 
@@ -238,14 +398,21 @@ def main():
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='192.168.0.22', credentials=credentials, heartbeat=65535))
     channel = connection.channel()
 
-  # Declare the queue from which to receive messages
-    channel.queue_declare(queue='data')
+  # Declare the queue from which to receive messages, together with its dead letter and parking lot queues
+    declare_data_queues(channel)
+
+    # Limit the number of messages that are delivered but not yet acknowledged
+    channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+
+    # Worker threads that process the received messages
+    executor = ThreadPoolExecutor(max_workers=WORKER_COUNT)
 
     # Set 'on_receive_message' as the callback function for received messages
-    channel.basic_consume(queue='data', on_message_callback=on_receive_message, auto_ack=False)
+    on_message_callback = functools.partial(on_receive_message, connection=connection, executor=executor)
+    channel.basic_consume(queue='data', on_message_callback=on_message_callback, auto_ack=False)
 
     # Print status
-    print('Awaiting messages. To exit press CTRL+C')
+    print(f'Awaiting messages with {WORKER_COUNT} workers. To exit press CTRL+C')
 
     try:
         # Start consumer in infinite loop.
@@ -253,6 +420,11 @@ def main():
     except KeyboardInterrupt:
         # Handle shutdown signal.
         channel.stop_consuming()
+
+        # Let the workers finish their current messages and send the outstanding acknowledgements
+        executor.shutdown(wait=True)
+        connection.process_data_events(time_limit=0)
+
         connection.close()
 
 